@@ -1,154 +1,433 @@
+from __future__ import annotations
 from pandas.core.frame import DataFrame
-from psycopg2.extensions import JSON
+import json
+import signal
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from operator import itemgetter
+from urllib.parse import urlparse
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING
 import requests
+import numpy as np
 import pandas as pd
 
 # Comment the line below if you want to input CLEINT_ID and CLIENT_SECRET directly in the script.
 import get_auth_code
-import database
+import http_session
+import cache
+import metrics
+import ratelimit
+
+# database (psycopg2) is imported in main, so that importing SpotifyAPI doesn't need it.
+if TYPE_CHECKING:
+    import database
+
+
+# Watch mode polling intervals in seconds. Recently played tracks endpoint keeps
+# the last 50 plays, so the maximum interval must be shorter than 50 tracks.
+WATCH_MIN_INTERVAL = 60
+WATCH_MAX_INTERVAL = 30 * 60
+HEALTH_PORT = 8081
+
+
+def batched(items: list, size: int) -> list:
+    """Splits the list into consecutive batches of at most `size` items."""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
 
 class SpotifyAPI():
 
     API_VERSION = "v1"
     BASE_URL = f"https://api.spotify.com/{API_VERSION}"
+    # Maximum number of IDs accepted by the several-artists endpoint.
+    ARTISTS_BATCH_SIZE = 50
+    # Maximum number of IDs accepted by the several-audio-features endpoint.
+    AUDIO_FEATURES_BATCH_SIZE = 100
+    # Maximum number of IDs accepted by the several-tracks endpoint.
+    TRACKS_BATCH_SIZE = 50
+    # Audio features merged into the tracks data.
+    AUDIO_FEATURES = [
+        "danceability",
+        "energy",
+        "key",
+        "loudness",
+        "mode",
+        "speechiness",
+        "acousticness",
+        "instrumentalness",
+        "liveness",
+        "valence",
+        "tempo",
+        "time_signature"
+        ]
+
+    # Columns of recently played tracks data: (object, key) in the item JSON.
+    RECENTLY_PLAYED_FIELDS = {
+        "artist_name": ("artist", "name"),
+        "track_name": ("track", "name"),
+        "album_name": ("album", "name"),
+        "album_release_date": ("album", "release_date"),
+        "artist_id": ("artist", "id"),
+        "track_id": ("track", "id"),
+        "album_id": ("album", "id"),
+        "track_popularity": ("track", "popularity"),
+        "played_at": ("item", "played_at"),
+        "duration_ms": ("track", "duration_ms"),
+        "is_explicit": ("track", "explicit")
+        }
+    # Non-text columns of recently played tracks data.
+    RECENTLY_PLAYED_DTYPES = {
+        "track_popularity": "int64",
+        "duration_ms": "int64",
+        "is_explicit": "bool"
+        }
+
+    # Columns of clean tracks data stored as categoricals.
+    CATEGORICAL_COLUMNS = ["artist_id", "track_id", "album_id", "artist_genres"]
+
+    # Columns of the tracks data loaded into database tables.
+    TABLE_COLUMNS = {
+        "albums": ["album_id", "album_name", "album_release_date"],
+        "artists": ["artist_id", "artist_name", "artist_popularity", "followers"],
+        "track_info": [
+            "track_id",
+            "track_name",
+            "track_popularity",
+            "danceability",
+            "energy",
+            "key",
+            "loudness",
+            "mode",
+            "speechiness",
+            "acousticness",
+            "instrumentalness",
+            "liveness",
+            "valence",
+            "tempo",
+            "duration_ms",
+            "time_signature",
+            "is_explicit"
+            ],
+        "recent_tracks": ["played_at", "track_id", "album_id", "artist_id"]
+        }
+    # Columns of the tracks data from which genres and artists_genres tables are derived.
+    GENRE_COLUMNS = ["artist_id", "artist_genres"]
+    # Tables returned by split_into_tables.
+    TABLES = ["albums", "artists", "genres", "track_info", "artists_genres", "recent_tracks"]
 
-    def __init__(self, token):
+    def __init__(self, token, session=None, cache=None, scheduler=None, staging=None):
         self.token = token
+        # Optional cache.MetadataCache of artists and audio features.
+        self.cache = cache
+        # Optional staging.StagingSink which keeps raw and clean tracks data as Parquet.
+        self.staging = staging
+        # ratelimit.RequestScheduler which sends all requests, shared by clients of the same API budget.
+        self.scheduler = scheduler if scheduler is not None else ratelimit.get_default_scheduler()
+        # Reuse pooled keep-alive connections between requests.
+        self.session = session if session is not None else http_session.get_default_session()
         self.headers = {
         "Accept": "application/json",
         "Content-Type": "application/json",
         "Authorization": f"Bearer {self.token}"
     }
 
-    def get_recently_played(self):
-        endpoint = f"{self.BASE_URL}/me/player/recently-played"
-        params = {"limit": 50} 
-        r = requests.get(endpoint, headers=self.headers, params=params)
-        if r.status_code not in range(200, 299):
-            print(r.json())
-            raise Exception("Could not get requested user data.")
-        
-        recently_played_json = r.json()
-        
-        artist_name = []
-        duration_ms = []
-        is_explicit = []
-        track_name = []
-        track_popularity = []
-        track_id = []
-        artist_id = []
-        played_at = []
-        album_release_date = []
-        album_name = []
-        album_id = []
-        
-        for song in recently_played_json["items"]:
-                artist_name.append(song["track"]["album"]["artists"][0]["name"])
-                track_name.append(song["track"]["name"])
-                album_name.append(song["track"]["album"]["name"])
-                album_release_date.append(song["track"]["album"]["release_date"])
-                artist_id.append(song["track"]["album"]["artists"][0]["id"])
-                track_id.append(song["track"]["id"])
-                album_id.append(song["track"]["album"]["id"])
-                track_popularity.append(song["track"]["popularity"])
-                played_at.append(song["played_at"])
-                duration_ms.append(song["track"]["duration_ms"])
-                is_explicit.append(song["track"]["explicit"])
+    def get_recently_played(self, after: datetime = None) -> DataFrame:
+        """Requests the last 50 played tracks. If `after` (UTC) is given, requests only 
+        tracks played after it, following the pagination until all pages are read."""
+        items = [item for page in self.iter_recently_played_pages(after) for item in page]
         
+        return self.flatten_recently_played(items)
 
-        tracks_dict = {
-            "artist_name": artist_name,
-            "track_name": track_name,
-            "album_name": album_name,
-            "album_release_date": album_release_date,
-            "artist_id": artist_id,
-            "track_id": track_id,
-            "album_id": album_id,
-            "track_popularity": track_popularity,
-            "played_at": played_at,
-            "duration_ms": duration_ms,
-            "is_explicit": is_explicit
-        }
 
-        tracks_df = pd.DataFrame(tracks_dict, columns=list(tracks_dict.keys()))
+    def iter_recently_played_pages(self, after: datetime = None):
+        """Yields items of recently played tracks page by page. If `after` (UTC) is not given,
+        only the first page (the last 50 played tracks) is requested."""
+        endpoint = f"{self.BASE_URL}/me/player/recently-played"
+        params = {"limit": 50}
+        if after is not None:
+            after = after.replace(tzinfo=timezone.utc)
+            params["after"] = int(after.timestamp() * 1000)
+        
+        while endpoint:
+            r = self.get_with_retries(endpoint, params)
+            if r.status_code not in range(200, 299):
+                print(r.text)
+                raise Exception("Could not get requested user data.")
+            recently_played_json = r.json()
+            items = recently_played_json["items"]
+            if after is not None:
+                # The next page URL carries the "before" cursor and pages back in time, 
+                # so it eventually reaches the plays played up to `after`, which are loaded.
+                items = [item for item in items if self.parse_played_at(item["played_at"]) > after]
+            if items:
+                yield items
+            if after is None or not items or len(items) < len(recently_played_json["items"]):
+                break
+            endpoint = recently_played_json.get("next")
+            params = None
+
+
+    @staticmethod
+    def parse_played_at(played_at: str) -> datetime:
+        """Parses played_at of recently played item, e.g. "2021-10-01T12:00:00.000Z", as UTC."""
+        return datetime.fromisoformat(played_at.replace("Z", "+00:00"))
+
+
+    @classmethod
+    def flatten_recently_played(cls, items: list) -> DataFrame:
+        """Flattens recently played items (of any number of pages) into tracks data.
+        Each column is extracted in single pass with precompiled getters."""
+        objects = {"item": items}
+        objects["track"] = list(map(itemgetter("track"), items))
+        objects["album"] = list(map(itemgetter("album"), objects["track"]))
+        # The first album artist is stored as the track's artist.
+        objects["artist"] = [album["artists"][0] for album in objects["album"]]
+
+        # Arrays of known dtype spare pandas the type inference over Python lists.
+        tracks_dict = {column: np.array(list(map(itemgetter(key), objects[level])), 
+                                        dtype=cls.RECENTLY_PLAYED_DTYPES.get(column, object))
+                       for column, (level, key) in cls.RECENTLY_PLAYED_FIELDS.items()}
+        tracks_df = pd.DataFrame(tracks_dict, columns=list(tracks_dict.keys()), copy=False)
     
         return tracks_df
 
 
     def get_artist_data(self, df: DataFrame) -> DataFrame:
-        artist_genres = []
-        artist_popularity = []
-        artist_followers = []
         df = df.drop_duplicates(subset=["artist_id"])
         artist_id_list = df["artist_id"].tolist()
-        artist_base_url = f"{self.BASE_URL}/artists"
+        artists, missing_ids = self.lookup_cache("artist", artist_id_list)
+        artists.update(self.store_in_cache("artist", self.request_artists(missing_ids)))
+
+        return self.build_artist_df(artist_id_list, artists)
+
+
+    def build_artist_df(self, artist_id_list: list, artists: dict) -> DataFrame:
+        """Builds artist data from artists' JSON keyed by artist ID."""
+        missing_ids = [id for id in artist_id_list if id not in artists]
+        if missing_ids:
+            print(f"No artist data returned for: {', '.join(missing_ids)}")
+        artist_id_list = [id for id in artist_id_list if id in artists]
 
-        for id in artist_id_list:
-            artist_url = f"{artist_base_url}/{id}"
-            r = requests.get(artist_url, headers=self.headers)
-            if r.status_code not in range(200, 299):
-                return []
-            genres = r.json()["genres"]
-            popularity = r.json()["popularity"]
-            followers = r.json()["followers"]["total"]
-            artist_genres.append(genres)
-            artist_popularity.append(popularity)
-            artist_followers.append(followers)
-            
-        artist_genres = [",".join(x) for x in artist_genres]
         artist_genres_df = pd.DataFrame(
             {"artist_id": artist_id_list,
-            "artist_popularity": artist_popularity,
-            "followers": artist_followers,
-            "artist_genres": artist_genres
+            "artist_popularity": [artists[id]["popularity"] for id in artist_id_list],
+            "followers": [artists[id]["followers"]["total"] for id in artist_id_list],
+            "artist_genres": [",".join(artists[id]["genres"]) for id in artist_id_list]
             })
         
         return artist_genres_df
 
 
+    def artist_requests(self, artist_ids: list) -> list:
+        """Returns (url, params) of the requests for artists in batches of up to ARTISTS_BATCH_SIZE IDs."""
+        artists_url = f"{self.BASE_URL}/artists"
+        return [(artists_url, {"ids": ",".join(ids)}) for ids in batched(artist_ids, self.ARTISTS_BATCH_SIZE)]
+
+
+    def request_artists(self, artist_ids: list) -> dict:
+        """Requests artists in batches. Returns artists' JSON keyed by artist ID. 
+        IDs which Spotify could not resolve are left out."""
+        responses = [self.get_json(url, params) for url, params in self.artist_requests(artist_ids)]
+        return self.collect_artists(responses)
+
+
+    @staticmethod
+    def collect_artists(responses: list) -> dict:
+        """Collects artists from several-artists responses, keyed by artist ID."""
+        return {artist["id"]: artist 
+                for response in responses 
+                for artist in response["artists"] 
+                if artist is not None}
+
+
+    def get_tracks(self, track_ids: list) -> dict:
+        """Returns tracks' JSON keyed by track ID, taken from the cache or requested in batches.
+        IDs which Spotify could not resolve are left out."""
+        tracks, missing_ids = self.lookup_cache("track", track_ids)
+        responses = [self.get_json(url, params) for url, params in self.track_requests(missing_ids)]
+        tracks.update(self.store_in_cache("track", self.collect_tracks(responses)))
+
+        return tracks
+
+
+    def track_requests(self, track_ids: list) -> list:
+        """Returns (url, params) of the requests for tracks in batches of up to TRACKS_BATCH_SIZE IDs."""
+        tracks_url = f"{self.BASE_URL}/tracks"
+        return [(tracks_url, {"ids": ",".join(ids)}) for ids in batched(track_ids, self.TRACKS_BATCH_SIZE)]
+
+
+    @staticmethod
+    def collect_tracks(responses: list) -> dict:
+        """Collects tracks from several-tracks responses, keyed by track ID."""
+        return {track["id"]: track 
+                for response in responses 
+                for track in response["tracks"] 
+                if track is not None}
+
+
     def get_track_features(self, df: DataFrame) -> DataFrame:
-        track_features = []
         df = df.drop_duplicates(subset=["track_id"])
         track_list = df["track_id"].tolist()
-        audio_features_base_url = f"{self.BASE_URL}/audio-features/"
+        track_features, missing_ids = self.lookup_cache("audio_features", track_list)
+        fetched = {features["id"]: features for features in self.request_audio_features(missing_ids)}
+        track_features.update(self.store_in_cache("audio_features", fetched))
 
-        for id in track_list:
-            audio_features_url = f"{audio_features_base_url}{id}"
-            r = requests.get(audio_features_url, headers=self.headers)
-            if r.status_code not in range(200, 299):
-                self.get_track_features(df=df)
-            features = r.json()
-            track_features.append(features)
-        
-        track_features_df = pd.DataFrame(track_features)
+        return self.build_track_features_df(track_list, track_features)
+
+
+    def build_track_features_df(self, track_list: list, track_features: dict) -> DataFrame:
+        """Builds track features data from audio features JSON keyed by track ID."""
+        track_features = [track_features[id] for id in track_list if id in track_features]
+        track_features_df = pd.DataFrame(track_features, columns=["id"] + self.AUDIO_FEATURES)
         track_features_df = track_features_df.rename(columns={"id": "track_id"})
-        track_features_df = track_features_df.drop(columns=["uri", 
-                                                            "track_href", 
-                                                            "analysis_url", 
-                                                            "duration_ms", 
-                                                            "type"])
         
         return track_features_df
 
 
-    def join_all_tracks_data(self) -> DataFrame:
-        recently_played = self.get_recently_played()
-        artist_data = self.get_artist_data(recently_played)
-        track_features = self.get_track_features(recently_played)
+    def audio_features_requests(self, track_ids: list) -> list:
+        """Returns (url, params) of the requests for audio features in batches of up to AUDIO_FEATURES_BATCH_SIZE IDs."""
+        audio_features_url = f"{self.BASE_URL}/audio-features"
+        return [(audio_features_url, {"ids": ",".join(ids)}) for ids in batched(track_ids, self.AUDIO_FEATURES_BATCH_SIZE)]
+
+
+    def request_audio_features(self, track_ids: list) -> list:
+        """Requests audio features in batches. Tracks without audio features are left out."""
+        responses = [self.get_json(url, params) for url, params in self.audio_features_requests(track_ids)]
+        return self.collect_audio_features(responses)
+
+
+    @staticmethod
+    def collect_audio_features(responses: list) -> list:
+        """Collects audio features from several-audio-features responses."""
+        # Tracks without audio features are returned as null.
+        return [features 
+                for response in responses 
+                for features in response["audio_features"] 
+                if features is not None]
+
 
-        all_data = pd.merge(recently_played, artist_data, on="artist_id", how="left")
+    def lookup_cache(self, entity: str, ids: list) -> tuple:
+        """Returns cached values keyed by ID and the list of IDs which have to be requested."""
+        if self.cache is None:
+            return {}, ids
+        cached = self.cache.get_many(entity, ids)
+
+        return cached, [id for id in ids if id not in cached]
+
+
+    def store_in_cache(self, entity: str, values: dict) -> dict:
+        """Stores requested values in the cache. Returns the values."""
+        if self.cache is not None and values:
+            self.cache.set_many(entity, values)
+
+        return values
+
+
+    def get_json(self, url: str, params: dict = None) -> dict:
+        """Performs GET request and returns the response JSON. Raises on non-2xx response."""
+        r = self.get_with_retries(url, params)
+        if r.status_code not in range(200, 299):
+            print(r.text)
+            raise Exception(f"Could not get {url}. Request status code: {r.status_code}")
+
+        return r.json()
+
+
+    def get_with_retries(self, url: str, params: dict = None) -> requests.Response:
+        """Performs GET request through the request scheduler, which paces it, retries it 
+        on 429 responses honoring Retry-After and adapts the rate. Returns the last response."""
+        # Last path segment, e.g. "artists" or "recently-played", keeps the label set small.
+        endpoint = urlparse(url).path.rstrip("/").rsplit("/", 1)[-1]
+
+        def send() -> requests.Response:
+            with metrics.registry.timer("http_request_seconds", endpoint=endpoint):
+                r = self.session.get(url, headers=self.headers, params=params)
+            metrics.inc("http_requests_total", endpoint=endpoint, status=r.status_code)
+            return r
+
+        return self.scheduler.request(send)
+
+
+    def join_all_tracks_data(self, db=None, after: datetime = None) -> DataFrame:
+        with metrics.stage("extract"):
+            recently_played = self.get_recently_played(after)
+        metrics.rows("extract", len(recently_played))
+
+        return self.enrich_tracks_data(recently_played, db)
+
+
+    def enrich_tracks_data(self, recently_played: DataFrame, db=None) -> DataFrame:
+        """Adds artist data and audio features to the tracks. If database.Database is given,
+        only artists and tracks missing from the database are requested from Spotify."""
+        if recently_played.empty:
+            return recently_played
+        with metrics.stage("enrich_db"):
+            known_artists, known_features, unseen_artists, unseen_tracks = self.split_known(recently_played, db)
+        with metrics.stage("enrich_api"):
+            artist_data = self.append_known(known_artists, self.get_artist_data(unseen_artists))
+            track_features = self.append_known(known_features, self.get_track_features(unseen_tracks))
+        with metrics.stage("merge"):
+            df = self.merge_tracks_data(recently_played, artist_data, track_features)
+        metrics.rows("merge", len(df))
+
+        return df
+
+
+    def split_known(self, recently_played: DataFrame, db=None) -> tuple:
+        """Reads artist data and audio features already stored in the database.
+        Returns them with the tracks whose artists and features are yet unseen."""
+        if db is None:
+            return None, None, recently_played, recently_played
+
+        known_artists = db.get_artist_data(recently_played["artist_id"].unique().tolist())
+        known_features = db.get_track_features(recently_played["track_id"].unique().tolist(), self.AUDIO_FEATURES)
+        unseen_artists = recently_played[~recently_played["artist_id"].isin(known_artists["artist_id"])]
+        unseen_tracks = recently_played[~recently_played["track_id"].isin(known_features["track_id"])]
+
+        return known_artists, known_features, unseen_artists, unseen_tracks
+
+
+    @staticmethod
+    def append_known(known: DataFrame, fetched: DataFrame) -> DataFrame:
+        """Appends data requested from Spotify to the data read from the database."""
+        if known is None:
+            return fetched
+
+        return pd.concat([known, fetched], ignore_index=True)
+
+
+    def merge_tracks_data(
+        self, 
+        recently_played: DataFrame, 
+        artist_data: DataFrame, 
+        track_features: DataFrame
+    ) -> DataFrame:
+        """Merges recently played tracks with artist data and audio features. Plays of artists
+        or tracks which Spotify could not resolve (e.g. deleted ones) are dropped and counted,
+        instead of failing validation of all the plays."""
+        all_data = pd.merge(recently_played, artist_data, on="artist_id", how="inner")
         all_data = pd.merge(all_data, track_features, on="track_id", how="inner")
+        dropped = len(recently_played) - len(all_data)
+        if dropped:
+            print(f"Dropped {dropped} plays without artist data or audio features.")
+            metrics.inc("plays_dropped_total", dropped, reason="missing_metadata")
 
         return all_data
         
 
     def clean_df(self, df: DataFrame) -> DataFrame:
-        # correct date if release date precision is year
-        df["album_release_date"] = [f"{x}-01-01" if len(x) == 4 else x for x in df["album_release_date"].tolist()]
-        # correct date if release date precision is month
-        df["album_release_date"] = [f"{x}-01" if len(x) == 7 else x for x in df["album_release_date"].tolist()]
+        release_date = df["album_release_date"]
+        precision = release_date.str.len()
+        # correct date if release date precision is year or month
+        release_date = release_date.mask(precision == 4, release_date + "-01-01")
+        release_date = release_date.mask(precision == 7, release_date + "-01")
+        df["album_release_date"] = pd.to_datetime(release_date, format="%Y-%m-%d")
         # fill the genre with default value if empty
-        df["artist_genres"] = ["<unknown>" if len(x) == 0 else x for x in df["artist_genres"].tolist()]
+        df["artist_genres"] = df["artist_genres"].mask(df["artist_genres"].str.len() == 0, "<unknown>")
+        # store repeated values once
+        df[self.CATEGORICAL_COLUMNS] = df[self.CATEGORICAL_COLUMNS].astype("category")
 
         return df
 
@@ -170,68 +449,241 @@ class SpotifyAPI():
         return True
 
 
-    def get_tracks_data(self) -> DataFrame:
-        tracks_dataset = self.join_all_tracks_data()
-        clean_tracks_dataset = self.clean_df(tracks_dataset)
-
-        if not self.check_if_data_valid(clean_tracks_dataset):
+    def get_tracks_data(self, db=None, after: datetime = None) -> DataFrame:
+        tracks_dataset = self.join_all_tracks_data(db, after)
+        if tracks_dataset.empty:
+            print("No new tracks played.")
             return pd.DataFrame()
+
+        return self.transform_tracks_data(tracks_dataset)
+
+
+    def transform_tracks_data(self, tracks_dataset: DataFrame) -> DataFrame:
+        """Stages raw tracks data, cleans and validates it and stages the clean data.
+        Returns the clean tracks data, or an empty DataFrame if it isn't valid."""
+        # Staged before cleaning, which modifies the DataFrame in place.
+        self.stage("raw", tracks_dataset)
+        with metrics.stage("clean"):
+            clean_tracks_dataset = self.clean_df(tracks_dataset)
+
+        with metrics.stage("validate"):
+            if not self.check_if_data_valid(clean_tracks_dataset):
+                return pd.DataFrame()
+        metrics.rows("validate", len(clean_tracks_dataset))
+        self.stage("clean", clean_tracks_dataset)
         
         return clean_tracks_dataset
 
 
+    def stage(self, kind: str, df: DataFrame) -> None:
+        """Writes "raw" or "clean" tracks data to the staging sink, if there is one."""
+        if self.staging is not None:
+            with metrics.stage("stage"):
+                self.staging.write(kind, df)
+
+
+    @classmethod
+    def source_columns(cls, tables: list) -> list:
+        """Returns the columns of clean tracks data needed to split off the tables."""
+        columns = []
+        for table_name in tables:
+            if table_name in ("genres", "artists_genres"):
+                table_columns = cls.GENRE_COLUMNS
+            else:
+                table_columns = cls.TABLE_COLUMNS[table_name]
+            columns.extend(column for column in table_columns if column not in columns)
+
+        return columns
+
+
+    def split_into_tables(self, df: DataFrame, user_id: str = None, tables: list = None) -> dict:
+        """Splits clean tracks data into DataFrames keyed by database table name.
+        If user_id is given, plays are tagged with it. If tables is given, only those
+        are split off, so df needs only their source_columns()."""
+        tables = tables or self.TABLES
+        if "genres" in tables or "artists_genres" in tables:
+            artist_genres_long = self.transform_artist_genres(df)
+        frames = {}
+        for table_name in tables:
+            if table_name == "genres":
+                frames[table_name] = artist_genres_long[["genre_name"]]
+            elif table_name == "artists_genres":
+                frames[table_name] = artist_genres_long
+            else:
+                frames[table_name] = df[self.TABLE_COLUMNS[table_name]]
+        if "recent_tracks" in frames and user_id is not None:
+            frames["recent_tracks"] = frames["recent_tracks"].assign(user_id=user_id)
+
+        return frames
+
+
     def transform_artist_genres(self, df: DataFrame) -> DataFrame:
-        artist_genres_wide = df["artist_genres"].str.split("," , expand=True)
-        artist_genres = pd.concat([df[["artist_id"]], artist_genres_wide], axis=1)
-        artist_genres_long = artist_genres.melt(id_vars="artist_id")
-        artist_genres_long = artist_genres_long.drop(columns=["variable"])
+        """Returns long table of unique artist-genre pairs."""
+        artist_genres = df[["artist_id", "artist_genres"]].drop_duplicates()
+        artist_genres_long = artist_genres.assign(genre_name=artist_genres["artist_genres"].str.split(","))
+        artist_genres_long = artist_genres_long.explode("genre_name")
+        artist_genres_long = artist_genres_long.drop(columns=["artist_genres"])
         artist_genres_long = artist_genres_long.dropna()
-        artist_genres_long = artist_genres_long.rename(columns={"value": "genre_name"})
+        artist_genres_long["genre_name"] = artist_genres_long["genre_name"].astype("category")
         
-        return artist_genres_long
+        return artist_genres_long.reset_index(drop=True)
 
   
+def load_new_tracks(client: SpotifyAPI, db: database.Database) -> int:
+    """Extracts the tracks played since the last loaded one and loads them.
+    Returns the number of new plays."""
+    df = client.get_tracks_data(db, after=db.get_last_played_at())
+
+    # Load only if new tracks were played.
+    if df.empty:
+        return 0
+    report = db.load_batch(client.split_into_tables(df))
+    for table_name, counts in report.items():
+        print(f"Table {table_name}: {counts['inserted']} rows inserted, {counts['skipped']} skipped.")
+
+    return report["recent_tracks"]["inserted"]
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+    """Serves watch mode status as JSON on GET /health and metrics in Prometheus
+    text format on GET /metrics."""
+
+    def do_GET(self) -> None:
+        if self.path == "/metrics":
+            self.send_payload(200, "text/plain; version=0.0.4", metrics.registry.to_prometheus().encode())
+            return
+        if self.path != "/health":
+            self.send_error(404)
+            return
+        status = dict(self.server.status)
+        healthy = status["consecutive_errors"] == 0
+        status["status"] = "ok" if healthy else "failing"
+        self.send_payload(200 if healthy else 503, "application/json", json.dumps(status, default=str).encode())
+
+
+    def send_payload(self, code: int, content_type: str, payload: bytes) -> None:
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+def watch(
+    db: database.Database,
+    metadata_cache: cache.MetadataCache,
+    min_interval: float = WATCH_MIN_INTERVAL,
+    max_interval: float = WATCH_MAX_INTERVAL,
+    health_port: int = HEALTH_PORT,
+    load_tracks=load_new_tracks,
+    staging=None
+) -> None:
+    """Loads new tracks with load_tracks(client, db) until SIGINT or SIGTERM, keeping database 
+    connection, HTTP session and token warm. Polls every min_interval seconds while tracks are 
+    being played and backs off exponentially up to max_interval when nothing new was played."""
+    stop_event = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stop_event.set())
+
+    tokens = get_auth_code.get_token_manager()
+    interval = min_interval
+    status = {
+        "started_at": datetime.now(),
+        "last_run_at": None,
+        "last_new_plays": 0,
+        "runs": 0,
+        "consecutive_errors": 0,
+        "interval": interval
+        }
+    health_server = ThreadingHTTPServer(("127.0.0.1", health_port), HealthHandler)
+    health_server.daemon_threads = True
+    health_server.status = status
+    threading.Thread(target=health_server.serve_forever, daemon=True).start()
+    print(f"Watching recently played tracks. Health endpoint: http://127.0.0.1:{health_port}/health, "
+          f"metrics: http://127.0.0.1:{health_port}/metrics")
+
+    while not stop_event.is_set():
+        try:
+            client = SpotifyAPI(tokens.get_token(), cache=metadata_cache, staging=staging)
+            with metrics.registry.timer("run_seconds"):
+                new_plays = load_tracks(client, db)
+            status["last_new_plays"] = new_plays
+            status["consecutive_errors"] = 0
+            interval = min_interval if new_plays else min(interval * 2, max_interval)
+        except Exception as error:
+            print(f"Run failed: {error}")
+            metrics.inc("run_errors_total")
+            status["consecutive_errors"] += 1
+            interval = min(interval * 2, max_interval)
+        status["runs"] += 1
+        status["last_run_at"] = datetime.now()
+        status["interval"] = interval
+        stop_event.wait(interval)
+
+    print("Shutting down...")
+    health_server.shutdown()
+    tokens.stop()
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load recently played Spotify tracks into the database.")
+    parser.add_argument("--watch", action="store_true", 
+                        help="keep running and poll for new tracks on an adaptive interval")
+    parser.add_argument("--min-interval", type=float, default=WATCH_MIN_INTERVAL, 
+                        help="seconds between polls while tracks are being played")
+    parser.add_argument("--max-interval", type=float, default=WATCH_MAX_INTERVAL, 
+                        help="maximum seconds between polls when nothing is played")
+    parser.add_argument("--health-port", type=int, default=HEALTH_PORT, 
+                        help="port of the /health endpoint in watch mode")
+    parser.add_argument("--pipeline", action="store_true", 
+                        help="load in chunks, overlapping enrichment of a chunk with the load of the previous one")
+    parser.add_argument("--stage", nargs="?", const="staging", metavar="DIR", 
+                        help="also write raw and clean tracks data as Parquet to DIR, replayable with staging.py")
+    parser.add_argument("--metrics-report", metavar="PATH", 
+                        help="write per-stage timings, HTTP and row counts as JSON to PATH after the run")
+    parser.add_argument("--profile", nargs="?", const="", metavar="PATH", 
+                        help="profile a single run with cProfile and tracemalloc, optionally dumping stats to PATH")
+    args = parser.parse_args()
+
+    import database
+    import pipeline
+
     auth_code = get_auth_code.obtain_auth_code()
     token = get_auth_code.get_token()
 
-    client = SpotifyAPI(token)
-    df = client.get_tracks_data()
-    db = database.Database()
-
-    
-    # albums
-    db.insert_into_table(df[["album_id", "album_name", "album_release_date"]], "albums")
-    
-    # artists
-    db.insert_into_table(df[["artist_id", "artist_name", "artist_popularity", "followers"]], "artists")
-
-    # track_info
-    db.insert_into_table(df[["track_id",
-						"track_name",
-						"track_popularity",
-						"danceability",
-						"energy",
-						"key",
-						"loudness",
-						"mode",
-						"speechiness",
-						"acousticness",
-						"instrumentalness",
-						"liveness",
-						"valence",
-						"tempo",
-						"duration_ms",
-						"time_signature",
-                        "is_explicit"]], "track_info")
-    
-    # artists_genres
-    artist_genres_long = client.transform_artist_genres(df)
-    db.insert_into_table(artist_genres_long[["artist_id"]], "artists")
-    db.insert_into_table(artist_genres_long[["genre_name"]], "genres")
-    db.insert_into_table(artist_genres_long, "artists_genres")
-
-    # recently_played
-    db.insert_into_table(df[["played_at", "track_id", "album_id", "artist_id"]], "recent_tracks")
-    
-    db.count_records()
\ No newline at end of file
+    # The pipeline loads in its own thread, which needs a second connection. Watch mode
+    # uses the pool also with one connection, which is health-checked and reconnected
+    # after Postgres restarts or dropped idle connections.
+    if args.pipeline:
+        db = database.Database(max_connections=2)
+    elif args.watch:
+        db = database.Database(max_connections=1)
+    else:
+        db = database.Database()
+    load_tracks = pipeline.load_recently_played if args.pipeline else load_new_tracks
+    metadata_cache = cache.MetadataCache()
+    staging_sink = None
+    if args.stage is not None:
+        # pyarrow is needed only for staging.
+        import staging
+        staging_sink = staging.StagingSink(args.stage)
+    if args.watch:
+        watch(db, metadata_cache, args.min_interval, args.max_interval, args.health_port, load_tracks, staging_sink)
+    else:
+        client = SpotifyAPI(token, cache=metadata_cache, staging=staging_sink)
+        if args.profile is not None:
+            with metrics.profile(args.profile or None):
+                load_tracks(client, db)
+        else:
+            with metrics.registry.timer("run_seconds"):
+                load_tracks(client, db)
+        for entity, counters in metadata_cache.stats().items():
+            print(f"Cache {entity}: {counters['hits']} hits, {counters['misses']} misses.")
+        db.count_records()
+    if args.metrics_report:
+        metrics.registry.write_report(args.metrics_report)
+        print(f"Metrics report written to {args.metrics_report}.")
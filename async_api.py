@@ -0,0 +1,157 @@
+import asyncio
+import threading
+import weakref
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from pandas.core.frame import DataFrame
+import pandas as pd
+
+import metrics
+from app import SpotifyAPI
+from ratelimit import AdaptiveRateLimiter, RequestScheduler
+
+
+# Default number of requests in flight and the global request rate (requests/s).
+CONCURRENCY = 10
+RATE_LIMIT = 20
+
+_default_scheduler = None
+_default_executor = None
+_default_lock = threading.Lock()
+
+
+def get_default_scheduler() -> RequestScheduler:
+    """Returns the request scheduler shared by all AsyncSpotifyAPI clients, creating it on first use."""
+    global _default_scheduler
+    with _default_lock:
+        if _default_scheduler is None:
+            _default_scheduler = RequestScheduler(AdaptiveRateLimiter(RATE_LIMIT, burst=CONCURRENCY), 
+                                                  workers=CONCURRENCY)
+
+    return _default_scheduler
+
+
+def get_default_executor() -> ThreadPoolExecutor:
+    """Returns the thread pool shared by all AsyncSpotifyAPI clients, creating it on first use."""
+    global _default_executor
+    with _default_lock:
+        if _default_executor is None:
+            _default_executor = ThreadPoolExecutor(max_workers=CONCURRENCY)
+
+    return _default_executor
+
+
+def close() -> None:
+    """Shuts down the shared scheduler and thread pool. They are created again on next use."""
+    global _default_scheduler, _default_executor
+    with _default_lock:
+        scheduler, executor = _default_scheduler, _default_executor
+        _default_scheduler = _default_executor = None
+    if executor is not None:
+        executor.shutdown(wait=True)
+    if scheduler is not None:
+        scheduler.close()
+
+
+class AsyncSpotifyAPI(SpotifyAPI):
+    """SpotifyAPI which issues its requests concurrently on asyncio event loop.
+
+    Requests are performed with the pooled session in `executor` by the workers of
+    `scheduler`, at most `concurrency` at a time per client and no faster than the
+    scheduler's rate limiter allows. By default all clients share one process-wide
+    scheduler and thread pool, so the request rate and the number of threads are
+    global however many clients there are; shut them down with close().
+    The session's pool size should not be lower than `concurrency`.
+    """
+
+    def __init__(self, token, session=None, cache=None, concurrency=CONCURRENCY, scheduler=None, staging=None,
+                 executor=None):
+        super().__init__(token, session, cache, scheduler or get_default_scheduler(), staging)
+        self.concurrency = concurrency
+        self.executor = executor or get_default_executor()
+        # Semaphores limiting the concurrency, one per event loop, as a semaphore can only
+        # be used on the loop it was first used on and get_tracks_data() runs a new loop each time.
+        self.semaphores = weakref.WeakKeyDictionary()
+
+
+    async def run_limited(self, func, *args):
+        """Runs blocking request function in the thread pool under concurrency limit.
+        Rate limit is applied to each request by the scheduler."""
+        loop = asyncio.get_running_loop()
+        semaphore = self.semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self.semaphores[loop] = asyncio.Semaphore(self.concurrency)
+        async with semaphore:
+            return await loop.run_in_executor(self.executor, func, *args)
+
+
+    async def get_json_async(self, url: str, params: dict = None) -> dict:
+        return await self.run_limited(self.get_json, url, params)
+
+
+    async def get_recently_played_async(self, after: datetime = None) -> DataFrame:
+        return await self.run_limited(self.get_recently_played, after)
+
+
+    async def get_artist_data_async(self, df: DataFrame) -> DataFrame:
+        df = df.drop_duplicates(subset=["artist_id"])
+        artist_id_list = df["artist_id"].tolist()
+        artists, missing_ids = self.lookup_cache("artist", artist_id_list)
+        responses = await asyncio.gather(*(self.get_json_async(url, params)
+                                           for url, params in self.artist_requests(missing_ids)))
+        artists.update(self.store_in_cache("artist", self.collect_artists(responses)))
+
+        return self.build_artist_df(artist_id_list, artists)
+
+
+    async def get_track_features_async(self, df: DataFrame) -> DataFrame:
+        df = df.drop_duplicates(subset=["track_id"])
+        track_list = df["track_id"].tolist()
+        track_features, missing_ids = self.lookup_cache("audio_features", track_list)
+        responses = await asyncio.gather(*(self.get_json_async(url, params)
+                                           for url, params in self.audio_features_requests(missing_ids)))
+        fetched = {features["id"]: features for features in self.collect_audio_features(responses)}
+        track_features.update(self.store_in_cache("audio_features", fetched))
+
+        return self.build_track_features_df(track_list, track_features)
+
+
+    async def join_all_tracks_data_async(self, db=None, after: datetime = None) -> DataFrame:
+        with metrics.stage("extract"):
+            recently_played = await self.get_recently_played_async(after)
+        metrics.rows("extract", len(recently_played))
+        if recently_played.empty:
+            return recently_played
+        with metrics.stage("enrich_db"):
+            known_artists, known_features, unseen_artists, unseen_tracks = self.split_known(recently_played, db)
+        with metrics.stage("enrich_api"):
+            artist_data, track_features = await asyncio.gather(
+                self.get_artist_data_async(unseen_artists),
+                self.get_track_features_async(unseen_tracks)
+                )
+            artist_data = self.append_known(known_artists, artist_data)
+            track_features = self.append_known(known_features, track_features)
+        with metrics.stage("merge"):
+            df = self.merge_tracks_data(recently_played, artist_data, track_features)
+        metrics.rows("merge", len(df))
+
+        return df
+
+
+    async def get_tracks_data_async(self, db=None, after: datetime = None) -> DataFrame:
+        tracks_dataset = await self.join_all_tracks_data_async(db, after)
+        if tracks_dataset.empty:
+            print("No new tracks played.")
+            return pd.DataFrame()
+
+        return self.transform_tracks_data(tracks_dataset)
+
+
+    def get_tracks_data(self, db=None, after: datetime = None) -> DataFrame:
+        return asyncio.run(self.get_tracks_data_async(db, after))
+
+
+async def gather_tracks_data(clients: list) -> list:
+    """Extracts tracks data for many users concurrently. Returns DataFrames in order of clients."""
+    return await asyncio.gather(*(client.get_tracks_data_async() for client in clients))
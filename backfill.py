@@ -0,0 +1,229 @@
+import os
+import sys
+import glob
+import json
+from datetime import datetime
+
+import get_auth_code
+import database
+import cache
+import metrics
+from app import SpotifyAPI
+from pipeline import Pipeline
+
+
+# If you run "python backfill.py <export directory or files>", the program will
+# load the listening history from Spotify's "Extended Streaming History" export
+# (Streaming_History_Audio_*.json files) into the database.
+
+EXPORT_FILES_PATTERN = "Streaming_History_Audio_*.json"
+CHECKPOINT_FILE = "backfill_checkpoint.json"
+# Number of export records transformed and loaded at once.
+CHUNK_SIZE = 5000
+# Number of characters read from export file at once.
+READ_SIZE = 1 << 16
+# Spotify counts a stream as a play after 30 seconds. Shorter streams (skips) are
+# not returned by the recently played endpoint, so they are not loaded either.
+MIN_MS_PLAYED = 30000
+# Format of the export's "ts", the end of the stream (UTC) with second precision.
+TS_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def iter_json_array(path: str, read_size: int = READ_SIZE):
+    """Yields objects of the top-level JSON array in the file one by one,
+    reading the file in blocks instead of loading it whole."""
+    decoder = json.JSONDecoder()
+    with open(path, encoding="utf-8") as f:
+        buffer = ""
+        pos = 0
+        in_array = False
+        while True:
+            # Skip whitespace and separators, reading more if the buffer is exhausted.
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buffer):
+                buffer = f.read(read_size)
+                pos = 0
+                if not buffer:
+                    raise ValueError(f"Unexpected end of file {path}.")
+                continue
+            if not in_array:
+                if buffer[pos] != "[":
+                    raise ValueError(f"File {path} does not contain JSON array.")
+                in_array = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                return
+            try:
+                record, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The record continues in the next block.
+                more = f.read(read_size)
+                if not more:
+                    raise
+                buffer = buffer[pos:] + more
+                pos = 0
+                continue
+            yield record
+            pos = end
+            if pos >= read_size:
+                buffer = buffer[pos:]
+                pos = 0
+
+
+def track_id_from_uri(uri: str) -> str:
+    """Returns track ID from "spotify:track:<id>" URI, or None."""
+    if not uri or not uri.startswith("spotify:track:"):
+        return None
+
+    return uri.rsplit(":", 1)[1]
+
+
+class Backfill:
+    """Loads export records in chunks: tracks are requested in batches, artists and
+    audio features only for IDs missing from the database. Chunks go through Pipeline,
+    so the requests for the next chunk overlap the load of the previous one. Progress 
+    is saved in the checkpoint file after each loaded chunk, so an interrupted backfill 
+    can be resumed. The database must be pooled, as Pipeline requires.
+
+    Streams shorter than MIN_MS_PLAYED are skipped, and so are plays already loaded
+    from the recently played endpoint, which are matched by track and by played_at
+    truncated to the second of the export's timestamps."""
+
+    def __init__(
+        self,
+        client: SpotifyAPI,
+        db: database.Database,
+        checkpoint_file: str = CHECKPOINT_FILE,
+        chunk_size: int = CHUNK_SIZE,
+        user_id: str = database.DEFAULT_USER
+    ) -> None:
+        self.client = client
+        self.db = db
+        self.user_id = user_id
+        self.checkpoint_file = checkpoint_file
+        self.chunk_size = chunk_size
+        self.checkpoint = self.read_checkpoint()
+
+
+    def read_checkpoint(self) -> dict:
+        """Returns the number of processed records keyed by file name."""
+        if not os.path.exists(self.checkpoint_file):
+            return {}
+        with open(self.checkpoint_file, encoding="utf-8") as f:
+            return json.load(f)
+
+
+    def write_checkpoint(self) -> None:
+        """Writes the checkpoint atomically, so that it is never left half-written."""
+        tmp_file = f"{self.checkpoint_file}.tmp"
+        with open(tmp_file, mode="w", encoding="utf-8") as f:
+            json.dump(self.checkpoint, f, indent=0)
+        os.replace(tmp_file, self.checkpoint_file)
+
+
+    def run(self, paths: list) -> None:
+        for path in paths:
+            self.load_file(path)
+
+
+    def load_file(self, path: str) -> None:
+        name = os.path.basename(path)
+        done = self.checkpoint.get(name, 0)
+        if done == -1:
+            print(f"Skipping {name}, already loaded.")
+            return
+
+        print(f"Loading {name} from record {done}...")
+        # Number of records read up to the end of each chunk, keyed by chunk index.
+        chunk_ends = {}
+
+        def on_loaded(index: int) -> None:
+            self.checkpoint[name] = chunk_ends.pop(index)
+            self.write_checkpoint()
+
+        report = Pipeline(self.client, self.db, self.user_id).run(self.iter_chunks(path, done, chunk_ends), on_loaded)
+        if "recent_tracks" in report:
+            print(f"Loaded {report['recent_tracks']['inserted']} plays, "
+                  f"skipped {report['recent_tracks']['skipped']} already loaded.")
+        # -1 marks the file as fully loaded.
+        self.checkpoint[name] = -1
+        self.write_checkpoint()
+
+
+    def iter_chunks(self, path: str, done: int, chunk_ends: dict):
+        """Yields recently played items of the file's records after the first `done`,
+        chunk by chunk, recording where each chunk ends in chunk_ends."""
+        chunk = []
+        index = 0
+        for i, record in enumerate(iter_json_array(path)):
+            if i < done:
+                continue
+            chunk.append(record)
+            if len(chunk) == self.chunk_size:
+                chunk_ends[index] = i + 1
+                yield self.to_items(chunk)
+                index += 1
+                chunk = []
+        if chunk:
+            chunk_ends[index] = i + 1
+            yield self.to_items(chunk)
+
+
+    def to_items(self, records: list) -> list:
+        """Turns export records into recently played items, requesting their tracks in batches."""
+        plays = [(record["ts"], track_id_from_uri(record.get("spotify_track_uri"))) for record in records
+                 if (record.get("ms_played") or 0) >= MIN_MS_PLAYED]
+        # Podcast episodes and other non-track records have no track URI.
+        plays = [(played_at, track_id) for played_at, track_id in plays if track_id is not None]
+        plays = self.drop_loaded(plays)
+        tracks = self.client.get_tracks(list({track_id for _, track_id in plays}))
+        # Tracks which Spotify could not resolve are skipped, so that they don't block the backfill.
+        unresolved = sum(track_id not in tracks for _, track_id in plays)
+        if unresolved:
+            print(f"Skipped {unresolved} plays of tracks which could not be resolved.")
+            metrics.inc("plays_dropped_total", unresolved, reason="missing_track")
+
+        return [{"played_at": played_at, "track": tracks[track_id]}
+                for played_at, track_id in plays if track_id in tracks]
+
+
+    def drop_loaded(self, plays: list) -> list:
+        """Drops (ts, track_id) plays which are already loaded with played_at in the same second."""
+        if not plays:
+            return plays
+        times = [datetime.strptime(played_at, TS_FORMAT) for played_at, _ in plays]
+        loaded = self.db.get_played_tracks(self.user_id, min(times), max(times))
+        new_plays = [play for play, played_at in zip(plays, times) if (played_at, play[1]) not in loaded]
+        if len(new_plays) < len(plays):
+            print(f"Skipped {len(plays) - len(new_plays)} plays which are already loaded.")
+
+        return new_plays
+
+
+def find_export_files(paths: list) -> list:
+    """Expands directories into the export files they contain."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, EXPORT_FILES_PATTERN))))
+        else:
+            files.append(path)
+
+    return files
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python backfill.py <export directory or files>")
+        sys.exit(1)
+
+    auth_code = get_auth_code.obtain_auth_code()
+    token = get_auth_code.get_token()
+
+    # Pipeline loads in its own thread, which needs a second connection.
+    db = database.Database(max_connections=2)
+    client = SpotifyAPI(token, cache=cache.MetadataCache())
+    Backfill(client, db).run(find_export_files(sys.argv[1:]))
+    db.count_records()
@@ -0,0 +1,785 @@
+import io
+import os
+import sys
+import json
+import random
+import subprocess
+import time
+import threading
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urlencode
+
+import requests
+
+import http_session
+
+
+# If you run "python benchmark.py <name>", the program will start a local
+# Spotify API stub server and run the selected benchmark against it.
+# Run "python benchmark.py record [path]" to record your own Spotify API responses,
+# which "python benchmark.py replay [path]" then serves instead of synthetic ones.
+
+# Default file of recorded responses, one JSON object per line.
+RECORDING_FILE = "recording.jsonl"
+# Synthetic plays are one second apart, starting at this time.
+PLAYS_START = datetime(2021, 10, 1)
+
+
+def fake_artist(artist_id: str) -> dict:
+    """Returns synthetic artist JSON."""
+    return {
+        "id": artist_id,
+        "genres": ["pop", "dance pop"],
+        "popularity": 50,
+        "followers": {"total": 1000}
+        }
+
+
+def fake_audio_features(track_id: str) -> dict:
+    """Returns synthetic audio features JSON."""
+    return {
+        "id": track_id,
+        "danceability": 0.5,
+        "energy": 0.5,
+        "key": 5,
+        "loudness": -6.0,
+        "mode": 1,
+        "speechiness": 0.05,
+        "acousticness": 0.1,
+        "instrumentalness": 0.0,
+        "liveness": 0.1,
+        "valence": 0.5,
+        "tempo": 120.0,
+        "type": "audio_features",
+        "uri": f"spotify:track:{track_id}",
+        "track_href": "",
+        "analysis_url": "",
+        "duration_ms": 200000,
+        "time_signature": 4
+        }
+
+
+def fake_played_at(i: int) -> str:
+    """Returns unique played_at of the i-th synthetic play."""
+    return f"{PLAYS_START + timedelta(seconds=i):%Y-%m-%dT%H:%M:%S}.000Z"
+
+
+def fake_played_at_ms(i: int) -> int:
+    """Returns played_at of the i-th synthetic play as Unix time in milliseconds."""
+    return int((PLAYS_START + timedelta(seconds=i)).replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def fake_play_index(ms: int) -> int:
+    """Returns the index of the last synthetic play played at or before Unix time `ms`."""
+    return (ms - fake_played_at_ms(0)) // 1000
+
+
+def fake_play(i: int, n_artists: int = 20, n_tracks: int = None) -> dict:
+    """Returns synthetic item of recently played tracks JSON. If n_tracks is given,
+    plays cycle through that many tracks, otherwise every play is of a new track."""
+    artist_id = f"artist{i % n_artists:06d}"
+    track = i % n_tracks if n_tracks else i
+    return {
+        "played_at": fake_played_at(i),
+        "track": {
+            "id": f"track{track:06d}",
+            "name": f"Track {track}",
+            "popularity": 40,
+            "duration_ms": 200000,
+            "explicit": False,
+            "album": {
+                "id": f"album{i % 50:06d}",
+                "name": f"Album {i % 50}",
+                "release_date": "2020-05-01",
+                "artists": [{"id": artist_id, "name": f"Artist {i % n_artists}"}]
+                }
+            }
+        }
+
+
+class RecordingSession(http_session.PooledSession):
+    """Pooled session which appends every JSON response to a file, in the format read
+    by load_recording()."""
+
+    def __init__(self, path: str = RECORDING_FILE) -> None:
+        super().__init__()
+        self.path = path
+        self.lock = threading.Lock()
+
+
+    def request(self, method, url, **kwargs) -> requests.Response:
+        r = super().request(method, url, **kwargs)
+        if r.headers.get("Content-Type", "").startswith("application/json"):
+            record = {
+                "endpoint": urlparse(url).path.rstrip("/").rsplit("/", 1)[-1],
+                "params": kwargs.get("params"),
+                "status": r.status_code,
+                "body": r.json()
+                }
+            with self.lock, open(self.path, mode="a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+
+        return r
+
+
+def record(path: str = RECORDING_FILE) -> None:
+    """Records responses of one extraction of your recently played tracks from Spotify."""
+    import get_auth_code
+    from app import SpotifyAPI
+
+    get_auth_code.obtain_auth_code()
+    client = SpotifyAPI(get_auth_code.get_token(), session=RecordingSession(path))
+    df = client.get_tracks_data()
+    print(f"Recorded responses for {len(df)} plays to {path}.")
+
+
+def load_recording(path: str = RECORDING_FILE) -> dict:
+    """Reads recorded responses into plays and artists, tracks and audio features keyed by ID."""
+    catalog = {"plays": [], "artists": {}, "tracks": {}, "audio-features": {}}
+    keys = {"artists": "artists", "tracks": "tracks", "audio-features": "audio_features"}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record["status"] not in range(200, 299):
+                continue
+            if record["endpoint"] == "recently-played":
+                catalog["plays"].extend(record["body"]["items"])
+                catalog["tracks"].update({item["track"]["id"]: item["track"] for item in record["body"]["items"]})
+            elif record["endpoint"] in keys:
+                catalog[record["endpoint"]].update(
+                    {value["id"]: value for value in record["body"][keys[record["endpoint"]]] if value is not None})
+    if not catalog["plays"]:
+        raise Exception(f"No recently played tracks recorded in {path}.")
+
+    return catalog
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Serves synthetic or recorded Spotify Web API responses.
+
+    Recently played tracks are paginated with "before" cursors, so that clients
+    requesting them with "after" read all n_plays plays page by page. Requests are delayed by the
+    latency plus exponentially distributed jitter, and a throttle_rate fraction
+    of them is answered with 429 and Retry-After.
+    """
+
+    # Keep connections alive so that pooled sessions can reuse them.
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; avoid Nagle delays on kept-alive sockets.
+    disable_nagle_algorithm = True
+
+    def do_GET(self) -> None:
+        server = self.server
+        time.sleep(server.latency + (server.random.expovariate(1 / server.jitter) if server.jitter else 0))
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        ids = params.get("ids", [""])[0].split(",")
+
+        if server.random.random() < server.throttle_rate:
+            server.throttled_count += 1
+            self.send_response(429)
+            self.send_header("Retry-After", str(server.retry_after))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if url.path.endswith("/me/player/recently-played"):
+            # Like the real endpoint: the latest plays after the "after" or before the "before" 
+            # cursor (Unix ms), newest first, and "next" pages back in time with "before".
+            limit = int(params.get("limit", ["50"])[0])
+            start, end = 0, server.n_plays
+            if "after" in params:
+                start = max(fake_play_index(int(params["after"][0])) + 1, 0)
+            if "before" in params:
+                end = min(fake_play_index(int(params["before"][0]) - 1) + 1, end)
+            indexes = range(end - 1, max(start, end - limit) - 1, -1)
+            body = {"items": [server.play(i) for i in indexes], "next": None, "cursors": None}
+            if indexes:
+                body["cursors"] = {"after": str(fake_played_at_ms(indexes[0])), 
+                                   "before": str(fake_played_at_ms(indexes[-1]))}
+                if indexes[-1] > 0:
+                    query = urlencode({"before": body["cursors"]["before"], "limit": limit})
+                    body["next"] = f"http://{self.headers['Host']}{url.path}?{query}"
+        elif url.path.endswith("/artists"):
+            body = {"artists": [server.lookup("artists", id, fake_artist) for id in ids]}
+        elif url.path.endswith("/tracks"):
+            body = {"tracks": [server.lookup("tracks", id, lambda id: fake_play(int(id.lstrip("track")))["track"]) 
+                               for id in ids]}
+        elif url.path.endswith("/audio-features"):
+            body = {"audio_features": [server.lookup("audio-features", id, fake_audio_features) for id in ids]}
+        else:
+            self.send_error(404)
+            return
+
+        server.request_count += 1
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    # Accept bursts of concurrent connections without SYN retransmits.
+    request_queue_size = 128
+    daemon_threads = True
+
+    def play(self, i: int) -> dict:
+        """Returns the i-th play, cycling through the recorded plays if there is a recording."""
+        if self.recording is None:
+            return fake_play(i, self.n_artists, self.n_tracks)
+        item = self.recording["plays"][i % len(self.recording["plays"])]
+
+        return {**item, "played_at": fake_played_at(i)}
+
+
+    def lookup(self, entity: str, id: str, fake) -> dict:
+        """Returns the recorded value of the entity, or a synthetic one if it wasn't recorded."""
+        if self.recording is not None and id in self.recording[entity]:
+            return self.recording[entity][id]
+
+        return fake(id)
+
+
+class StubServer:
+    """Runs StubHandler in a background thread. Use as a context manager.
+
+    Serves n_plays synthetic plays of n_tracks tracks by n_artists artists, or cycles
+    through the plays of a recording loaded by load_recording().
+    """
+
+    def __init__(
+        self,
+        latency: float = 0,
+        jitter: float = 0,
+        throttle_rate: float = 0,
+        retry_after: int = 1,
+        n_plays: int = 50,
+        n_artists: int = 20,
+        n_tracks: int = None,
+        recording: dict = None
+    ) -> None:
+        self.httpd = StubHTTPServer(("127.0.0.1", 0), StubHandler)
+        self.httpd.latency = latency
+        self.httpd.jitter = jitter
+        self.httpd.throttle_rate = throttle_rate
+        self.httpd.retry_after = retry_after
+        self.httpd.n_plays = n_plays
+        self.httpd.n_artists = n_artists
+        self.httpd.n_tracks = n_tracks
+        self.httpd.recording = recording
+        # Seeded, so that runs inject the same delays and 429 responses.
+        self.httpd.random = random.Random(0)
+        self.httpd.request_count = 0
+        self.httpd.throttled_count = 0
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_port}/v1"
+
+
+    @property
+    def request_count(self) -> int:
+        return self.httpd.request_count
+
+
+    @property
+    def throttled_count(self) -> int:
+        return self.httpd.throttled_count
+
+
+    def __enter__(self) -> "StubServer":
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+
+    def __exit__(self, *exc) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def benchmark_session(n_requests: int = 500) -> None:
+    """Compares per-request overhead of bare requests.get and the pooled session."""
+    with StubServer() as stub:
+        url = f"{stub.base_url}/artists"
+        session = http_session.create_session()
+        for name, get in [("requests.get", requests.get), ("pooled session", session.get)]:
+            start = time.perf_counter()
+            for i in range(n_requests):
+                get(url, params={"ids": f"artist{i:06d}"}).raise_for_status()
+            elapsed = time.perf_counter() - start
+            print(f"{name:>16}: {elapsed / n_requests * 1000:.3f} ms/request, "
+                  f"{n_requests / elapsed:.0f} requests/s")
+
+
+def benchmark_async(n_users: int = 20, latency: float = 0.05, concurrency: int = 10) -> None:
+    """Compares serial SpotifyAPI with AsyncSpotifyAPI extracting data for many users."""
+    import asyncio
+    from app import SpotifyAPI
+    from concurrent.futures import ThreadPoolExecutor
+    from async_api import AsyncSpotifyAPI, gather_tracks_data
+    from ratelimit import RateLimiter, RequestScheduler
+
+    with StubServer(latency=latency) as stub:
+        session = http_session.create_session(pool_size=concurrency)
+        scheduler = RequestScheduler(RateLimiter(rate=1000, burst=concurrency), workers=concurrency)
+
+        start = time.perf_counter()
+        serial_results = []
+        for _ in range(n_users):
+            client = SpotifyAPI("token", session=session, scheduler=scheduler)
+            client.BASE_URL = stub.base_url
+            serial_results.append(client.get_tracks_data())
+        serial_elapsed = time.perf_counter() - start
+
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        clients = [AsyncSpotifyAPI("token", session=session, concurrency=concurrency, scheduler=scheduler,
+                                   executor=executor)
+                   for _ in range(n_users)]
+        for client in clients:
+            client.BASE_URL = stub.base_url
+        start = time.perf_counter()
+        async_results = asyncio.run(gather_tracks_data(clients))
+        async_elapsed = time.perf_counter() - start
+        executor.shutdown()
+        scheduler.close()
+
+    assert all(a.equals(b) for a, b in zip(serial_results, async_results))
+    print(f"{n_users} users, {latency * 1000:.0f} ms injected latency")
+    print(f"  serial: {serial_elapsed:.2f} s")
+    print(f"   async: {async_elapsed:.2f} s ({serial_elapsed / async_elapsed:.1f}x)")
+
+
+def flatten_items_loop(items: list):
+    """Reference implementation: flattens recently played items item by item."""
+    import pandas as pd
+
+    columns = {column: [] for column in ["artist_name", "track_name", "album_name", "album_release_date", 
+                                         "artist_id", "track_id", "album_id", "track_popularity", 
+                                         "played_at", "duration_ms", "is_explicit"]}
+    for song in items:
+        columns["artist_name"].append(song["track"]["album"]["artists"][0]["name"])
+        columns["track_name"].append(song["track"]["name"])
+        columns["album_name"].append(song["track"]["album"]["name"])
+        columns["album_release_date"].append(song["track"]["album"]["release_date"])
+        columns["artist_id"].append(song["track"]["album"]["artists"][0]["id"])
+        columns["track_id"].append(song["track"]["id"])
+        columns["album_id"].append(song["track"]["album"]["id"])
+        columns["track_popularity"].append(song["track"]["popularity"])
+        columns["played_at"].append(song["played_at"])
+        columns["duration_ms"].append(song["track"]["duration_ms"])
+        columns["is_explicit"].append(song["track"]["explicit"])
+
+    return pd.DataFrame(columns, columns=list(columns.keys()))
+
+
+def benchmark_flatten(scales: tuple = (50, 5_000, 500_000), repeat: int = 3) -> None:
+    """Compares per-item loop with column extraction of SpotifyAPI.flatten_recently_played."""
+    from app import SpotifyAPI
+
+    for n_items in scales:
+        items = [fake_play(i) for i in range(n_items)]
+        assert flatten_items_loop(items).equals(SpotifyAPI.flatten_recently_played(items))
+        for name, flatten in [("per-item loop", flatten_items_loop), 
+                              ("column extraction", SpotifyAPI.flatten_recently_played)]:
+            elapsed = min(timed(flatten, items) for _ in range(repeat))
+            print(f"{n_items:>7} items {name:>18}: {elapsed * 1000:.2f} ms")
+
+
+def synthetic_history(n_rows: int, n_artists: int = 5000, n_tracks: int = 50000):
+    """Returns synthetic merged tracks data with the columns transformed by SpotifyAPI.clean_df."""
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(0)
+    artist_idx = rng.integers(0, n_artists, n_rows)
+    track_idx = rng.integers(0, n_tracks, n_rows)
+    # Up to 12 genres per artist, some artists without any.
+    artist_genres = np.array([",".join(f"genre {g}" for g in range(i % 13)) for i in range(n_artists)], dtype=object)
+    release_dates = np.array(["1999", "1999-05", "1999-05-17"], dtype=object)
+
+    return pd.DataFrame({
+        "album_release_date": release_dates[track_idx % 3],
+        "artist_genres": artist_genres[artist_idx],
+        "artist_id": np.char.add("artist", artist_idx.astype(str)).astype(object),
+        "track_id": np.char.add("track", track_idx.astype(str)).astype(object),
+        "album_id": np.char.add("album", (track_idx // 10).astype(str)).astype(object)
+        })
+
+
+def clean_df_loop(df):
+    """Reference implementation of SpotifyAPI.clean_df with list comprehensions."""
+    df["album_release_date"] = [f"{x}-01-01" if len(x) == 4 else x for x in df["album_release_date"].tolist()]
+    df["album_release_date"] = [f"{x}-01" if len(x) == 7 else x for x in df["album_release_date"].tolist()]
+    df["artist_genres"] = ["<unknown>" if len(x) == 0 else x for x in df["artist_genres"].tolist()]
+    return df
+
+
+def transform_artist_genres_wide(df):
+    """Reference implementation of SpotifyAPI.transform_artist_genres with wide split and melt."""
+    import pandas as pd
+
+    artist_genres_wide = df["artist_genres"].str.split(",", expand=True)
+    artist_genres = pd.concat([df[["artist_id"]], artist_genres_wide], axis=1)
+    artist_genres_long = artist_genres.melt(id_vars="artist_id")
+    artist_genres_long = artist_genres_long.drop(columns=["variable"]).dropna()
+    return artist_genres_long.rename(columns={"value": "genre_name"})
+
+
+def benchmark_transform(n_rows: int = 1_000_000) -> None:
+    """Compares time and peak memory of the list-based and vectorized transforms."""
+    import tracemalloc
+    from app import SpotifyAPI
+
+    client = SpotifyAPI("token")
+    for name, clean, transform in [("lists + melt", clean_df_loop, transform_artist_genres_wide),
+                                   ("vectorized + explode", client.clean_df, client.transform_artist_genres)]:
+        df = synthetic_history(n_rows)
+        tracemalloc.start()
+        start = time.perf_counter()
+        clean_df = clean(df)
+        artist_genres_long = transform(clean_df)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        size = clean_df.memory_usage(deep=True).sum() + artist_genres_long.memory_usage(deep=True).sum()
+        print(f"{name:>21}: {elapsed:.2f} s, peak {peak / 2 ** 20:.0f} MiB, "
+              f"result {size / 2 ** 20:.0f} MiB ({len(artist_genres_long)} artist-genre rows)")
+
+
+def timed(func, *args) -> float:
+    """Returns the wall-clock time of the call in seconds."""
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def synthetic_plays(n_rows: int):
+    """Returns synthetic rows of recent_tracks table."""
+    import pandas as pd
+
+    played_at = pd.date_range("2000-01-01", periods=n_rows, freq="s")
+    return pd.DataFrame({
+        "played_at": played_at.strftime("%Y-%m-%d %H:%M:%S"),
+        "track_id": [f"track{i % 10000:06d}" for i in range(n_rows)],
+        "album_id": [f"album{i % 1000:06d}" for i in range(n_rows)],
+        "artist_id": [f"artist{i % 500:06d}" for i in range(n_rows)]
+        })
+
+
+def insert_numpy_tuples(db, data, table_name: str) -> None:
+    """Inserts data the way Database.insert_into_table did before the COPY loader: 
+    through a NumPy array into a list of row tuples, sent with execute_values."""
+    from psycopg2.extras import execute_values
+
+    df_numpy = data.to_numpy()
+    df_tuples = [tuple(row) for row in list(df_numpy)]
+    cols = ','.join(list(data.columns))
+    query = "INSERT INTO {} ({}) VALUES %s ON CONFLICT DO NOTHING".format(table_name, cols)
+    with db.get_cursor() as cursor:
+        execute_values(cursor, query, df_tuples)
+
+
+def benchmark_load(scales: tuple = (10_000, 100_000, 1_000_000)) -> None:
+    """Compares the original NumPy tuples loader with the current execute_values and
+    COPY loaders on a scratch table. Requires database parameters in the environment, 
+    the same as database.Database."""
+    import database
+
+    db = database.Database()
+    db.cursor.execute("""DROP TABLE IF EXISTS bench_recent_tracks;
+                         CREATE TABLE bench_recent_tracks (
+                             played_at timestamp PRIMARY KEY, 
+                             track_id TEXT, 
+                             album_id TEXT, 
+                             artist_id TEXT)""")
+    for n_rows in scales:
+        df = synthetic_plays(n_rows)
+        loaders = [
+            ("NumPy tuples", lambda df, table_name: insert_numpy_tuples(db, df, table_name)),
+            ("execute_values", db.insert_into_table), 
+            ("COPY", db.bulk_insert_into_table)
+            ]
+        for name, load in loaders:
+            db.cursor.execute("TRUNCATE bench_recent_tracks")
+            start = time.perf_counter()
+            load(df, "bench_recent_tracks")
+            elapsed = time.perf_counter() - start
+            print(f"{n_rows:>9} rows {name:>15}: {elapsed:.2f} s, {n_rows / elapsed:.0f} rows/s")
+    db.cursor.execute("DROP TABLE bench_recent_tracks")
+
+
+# Queries of the layout benchmark: name -> SQL with %(day)s, %(month)s and %(track_id)s parameters.
+LAYOUT_QUERIES = {
+    "day (expression)": """
+        SELECT COUNT(*) FROM recent_tracks
+        WHERE EXTRACT(YEAR FROM played_at) || '-' || EXTRACT(MONTH FROM played_at) 
+              || '-' || EXTRACT(DAY FROM played_at) = %(day_str)s""",
+    "day (range)": """
+        SELECT COUNT(*) FROM recent_tracks 
+        WHERE played_at >= %(day)s AND played_at < %(day)s::date + 1""",
+    "month top artists": """
+        SELECT artist_id, COUNT(*) FROM recent_tracks
+        WHERE played_at >= %(month)s AND played_at < %(month)s::date + interval '1 month'
+        GROUP BY artist_id ORDER BY 2 DESC LIMIT 10""",
+    "track plays": "SELECT COUNT(*) FROM recent_tracks WHERE track_id = %(track_id)s",
+    "delete track (FK check)": """
+        DELETE FROM track_info WHERE track_id = 'unplayed';
+        INSERT INTO track_info VALUES ('unplayed')"""
+    }
+
+
+def create_layout(db, schema: str, partitioned: bool, n_rows: int) -> None:
+    """Creates recent_tracks with n_rows synthetic plays over two years in the schema, 
+    either as the single table of earlier versions or partitioned by month with indexes."""
+    db.cursor.execute(f"""
+        DROP SCHEMA IF EXISTS {schema} CASCADE;
+        CREATE SCHEMA {schema};
+        SET search_path TO {schema};
+        CREATE TABLE track_info (track_id TEXT PRIMARY KEY);
+        INSERT INTO track_info SELECT 't' || i FROM generate_series(0, 49999) i;
+        INSERT INTO track_info VALUES ('unplayed');""")
+    cols = {
+        "id": "bigserial",
+        "user_id": "TEXT NOT NULL DEFAULT 'default'",
+        "played_at": "timestamp NOT NULL",
+        "track_id": "TEXT REFERENCES track_info (track_id)",
+        "album_id": "TEXT",
+        "artist_id": "TEXT"
+        }
+    if partitioned:
+        db.create_table(cols, "recent_tracks", partition_by="RANGE (played_at)")
+        db.partitions = None
+        db.ensure_partitions(datetime(2020, 1, 1), datetime(2021, 12, 31))
+    else:
+        db.create_table(cols, "recent_tracks")
+    db.add_pk("recent_tracks", f"{schema}_pk", "user_id, played_at")
+    if partitioned:
+        for column in ["track_id", "album_id", "artist_id", "played_at"]:
+            db.add_index("recent_tracks", f"{schema}_{column}_idx", column)
+    db.cursor.execute(f"""
+        INSERT INTO recent_tracks (played_at, track_id, album_id, artist_id)
+        SELECT timestamp '2020-01-01' + i * (interval '730 days' / {n_rows}), 
+               't' || i % 50000, 'al' || i % 20000, 'a' || i % 5000
+        FROM generate_series(0, {n_rows - 1}) i;
+        ANALYZE;
+        RESET search_path""")
+
+
+def benchmark_layout(n_rows: int = 2_000_000, repeat: int = 3) -> None:
+    """Compares queries on the single recent_tracks table of earlier versions and 
+    on the monthly partitioned layout with indexes. Requires database parameters 
+    in the environment, the same as database.Database."""
+    import database
+
+    db = database.Database()
+    layouts = {"single table": "bench_single", "partitioned": "bench_partitioned"}
+    for name, schema in layouts.items():
+        elapsed = timed(create_layout, db, schema, name == "partitioned", n_rows)
+        print(f"{name:>24}: {n_rows} rows created in {elapsed:.1f} s")
+
+    params = {"day": "2021-06-15", "day_str": "2021-6-15", "month": "2021-06-01", "track_id": "t123"}
+    print(f"{'query':>24} " + " ".join(f"{name:>14}" for name in layouts))
+    for query_name, query in LAYOUT_QUERIES.items():
+        times = []
+        for schema in layouts.values():
+            db.cursor.execute(f"SET search_path TO {schema}")
+            times.append(min(timed(db.cursor.execute, query, params) for _ in range(repeat)))
+        print(f"{query_name:>24} " + " ".join(f"{elapsed * 1000:>11.1f} ms" for elapsed in times))
+
+    db.cursor.execute("RESET search_path")
+    for schema in layouts.values():
+        db.cursor.execute(f"DROP SCHEMA {schema} CASCADE")
+
+
+# Scratch schema of the replay benchmark, dropped and migrated afresh for every scale.
+REPLAY_SCHEMA = "bench_replay"
+
+
+def scratch_database(schema: str = REPLAY_SCHEMA):
+    """Recreates the schema in the configured database and returns database.Database
+    connected to it, with all migrations applied."""
+    import database
+    import migrations
+
+    params = database.get_db_params()
+    with redirect_stdout(io.StringIO()):
+        admin = database.Database(params)
+        admin.cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema}")
+        admin.close()
+        db = database.Database({**params, "options": f"-c search_path={schema}"})
+        migrations.run_migrations(db)
+
+    return db
+
+
+def benchmark_replay(
+    scales: tuple = (1_000, 10_000, 50_000),
+    latency: float = 0.01,
+    jitter: float = 0.005,
+    throttle_rate: float = 0.01,
+    retry_after: int = 1,
+    recording: str = None,
+    rate: float = None
+) -> None:
+    """Extracts plays from the stub with SpotifyAPI.get_tracks_data and loads them
+    into a scratch schema at several scales, reporting throughput, HTTP latency 
+    percentiles per endpoint, time per stage and peak RSS. Serves the recorded 
+    responses if the path of a recording is given, otherwise synthetic ones. Requests
+    start at `rate` per second (ratelimit.MAX_RATE by default) and adapt to the 429s.
+    Requires database parameters in the environment, the same as database.Database."""
+    import resource
+    import metrics
+    from app import SpotifyAPI
+    import ratelimit
+
+    catalog = load_recording(recording) if recording else None
+    print(f"{latency * 1000:.0f} ms latency + {jitter * 1000:.0f} ms mean jitter, "
+          f"{throttle_rate:.0%} throttled with Retry-After {retry_after} s, "
+          + (f"replaying {len(catalog['plays'])} recorded plays" if catalog else "synthetic plays"))
+    for n_plays in scales:
+        db = scratch_database()
+        metrics.registry.reset()
+        stub = StubServer(latency, jitter, throttle_rate, retry_after, n_plays=n_plays, 
+                          n_artists=max(n_plays // 50, 20), n_tracks=max(n_plays // 4, 1), recording=catalog)
+        # Fresh scheduler, so that every scale starts at the same request rate.
+        scheduler = ratelimit.RequestScheduler(ratelimit.AdaptiveRateLimiter(rate or ratelimit.MAX_RATE))
+        with stub, redirect_stdout(io.StringIO()):
+            client = SpotifyAPI("token", session=http_session.create_session(), scheduler=scheduler)
+            client.BASE_URL = stub.base_url
+            start = time.perf_counter()
+            df = client.get_tracks_data(db, after=PLAYS_START - timedelta(days=1))
+            report = db.load_batch(client.split_into_tables(df))
+            elapsed = time.perf_counter() - start
+        requests_stats = scheduler.stats()
+        scheduler.close()
+        loaded = report["recent_tracks"]["inserted"]
+        if loaded != n_plays:
+            raise Exception(f"Loaded {loaded} of {n_plays} plays.")
+
+        # ru_maxrss is in KiB on Linux; it is the peak of the whole process so far.
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+        summary = metrics.registry.report()
+        print(f"{n_plays:>7} plays: {elapsed:.2f} s, {n_plays / elapsed:.0f} plays/s, "
+              f"{stub.request_count + stub.throttled_count} requests ({stub.throttled_count} throttled), "
+              f"final rate {requests_stats['rate']:.1f} requests/s, peak RSS {peak_rss:.0f} MiB")
+        for labels, latencies in summary["histograms"]["http_request_seconds"].items():
+            print(f"  {labels.split('=')[1]:>16}: {latencies['count']:>5} requests, " 
+                  + ", ".join(f"{q} {latencies[q] * 1000:.1f} ms" for q in ["p50", "p95", "p99", "max"]))
+        print("  stages: " + ", ".join(f"{labels.split('=')[1]} {times['sum']:.2f} s" 
+                                       for labels, times in summary["histograms"]["stage_seconds"].items()))
+        db.cursor.execute(f"DROP SCHEMA {REPLAY_SCHEMA} CASCADE")
+        db.close()
+
+
+def benchmark_staging(n_plays: int = 20_000, latency: float = 0.01) -> None:
+    """Compares rebuilding the database from the (stubbed) API with replaying the same
+    plays from Parquet staging. Requires database parameters in the environment and pyarrow."""
+    import shutil
+    import tempfile
+    import ratelimit
+    import staging
+    from app import SpotifyAPI
+
+    directory = tempfile.mkdtemp()
+    sink = staging.StagingSink(directory)
+    db = scratch_database()
+    with StubServer(latency, n_plays=n_plays, n_artists=max(n_plays // 50, 20), n_tracks=n_plays // 4) as stub, \
+            redirect_stdout(io.StringIO()):
+        scheduler = ratelimit.RequestScheduler(ratelimit.AdaptiveRateLimiter(ratelimit.MAX_RATE))
+        client = SpotifyAPI("token", session=http_session.create_session(), scheduler=scheduler, staging=sink)
+        client.BASE_URL = stub.base_url
+        start = time.perf_counter()
+        db.load_batch(client.split_into_tables(client.get_tracks_data(db, after=PLAYS_START - timedelta(days=1))))
+        api_elapsed = time.perf_counter() - start
+        scheduler.close()
+    size = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory) for name in names)
+    print(f"{n_plays} plays, {size / 2 ** 20:.1f} MiB staged")
+    print(f"{'from API':>16}: {api_elapsed:.2f} s")
+
+    for kind in staging.KINDS:
+        db = scratch_database()
+        with redirect_stdout(io.StringIO()):
+            elapsed = timed(staging.replay, db, sink, kind)
+        db.cursor.execute("SELECT COUNT(*) FROM recent_tracks")
+        print(f"{f'replay {kind}':>16}: {elapsed:.2f} s ({db.cursor.fetchone()[0]} plays)")
+    db.cursor.execute(f"DROP SCHEMA {REPLAY_SCHEMA} CASCADE")
+    shutil.rmtree(directory)
+
+
+# Heavy dependencies which must not be loaded by importing the module; CLI startup
+# regresses if they are.
+LAZY_IMPORTS = {
+    "get_auth_code": ["flask", "pandas", "psycopg2"],
+    "database": ["flask", "pandas"],
+    "app": ["flask", "psycopg2"]
+    }
+
+
+def import_time(module: str) -> tuple:
+    """Imports the module in fresh interpreter with "-X importtime". Returns cumulative
+    import time in seconds and the names of all imported modules."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True
+        )
+    cumulative = 0
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, us, name = line.split("|")
+        name = name.strip()
+        imported.add(name)
+        if name == module:
+            cumulative = int(us) / 1e6
+
+    return cumulative, imported
+
+
+def benchmark_imports(repeat: int = 5) -> None:
+    """Reports import time of the CLI modules and fails if heavy dependencies are loaded eagerly."""
+    failed = []
+    for module, lazy in LAZY_IMPORTS.items():
+        times = []
+        for _ in range(repeat):
+            cumulative, imported = import_time(module)
+            times.append(cumulative)
+        eager = [name for name in lazy if name in imported]
+        print(f"{module:>15}: {min(times) * 1000:.0f} ms" + (f", eagerly imports {', '.join(eager)}" if eager else ""))
+        if eager:
+            failed.append(module)
+
+    if failed:
+        raise Exception(f"Import time regression in: {', '.join(failed)}")
+
+
+BENCHMARKS = {
+    "session": benchmark_session,
+    "async": benchmark_async,
+    "load": benchmark_load,
+    "flatten": benchmark_flatten,
+    "transform": benchmark_transform,
+    "imports": benchmark_imports,
+    "layout": benchmark_layout,
+    "replay": benchmark_replay,
+    "staging": benchmark_staging
+    }
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["record"]:
+        record(*sys.argv[2:3])
+        sys.exit(0)
+    if sys.argv[1:2] == ["replay"] and len(sys.argv) > 2:
+        benchmark_replay(recording=sys.argv[2])
+        sys.exit(0)
+
+    names = sys.argv[1:] or list(BENCHMARKS.keys())
+    for name in names:
+        print(f"--- {name} ---")
+        BENCHMARKS[name]()
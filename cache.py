@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+CACHE_FILE = "metadata_cache.sqlite"
+# Maximum number of entries kept in memory.
+MAX_SIZE = 10000
+# Time to live of cached entries in seconds per entity; None never expires.
+# Artist and track popularity change over time, audio features do not.
+TTL = {
+    "artist": 24 * 60 * 60,
+    "track": 24 * 60 * 60,
+    "audio_features": None
+    }
+
+
+class MetadataCache:
+    """Cache of Spotify metadata keyed by entity ("artist", "track", "audio_features") and ID.
+
+    Entries are looked up in in-memory LRU tier first and in SQLite file second.
+    Pass path=None to keep the cache in memory only. Hits and misses are counted
+    per entity, so that stats() shows how many API lookups were saved.
+    """
+
+    def __init__(self, path: str = CACHE_FILE, max_size: int = MAX_SIZE, ttl: dict = None) -> None:
+        self.max_size = max_size
+        self.ttl = dict(TTL, **(ttl or {}))
+        self.memory = OrderedDict()
+        self.hits = {}
+        self.misses = {}
+        self.lock = threading.Lock()
+        self.db = None
+        if path is not None:
+            if not os.path.isabs(path):
+                path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("""CREATE TABLE IF NOT EXISTS metadata (
+                                   entity TEXT,
+                                   id TEXT,
+                                   value TEXT,
+                                   stored_at REAL,
+                                   PRIMARY KEY (entity, id))""")
+            self.db.commit()
+
+
+    def is_fresh(self, entity: str, stored_at: float) -> bool:
+        ttl = self.ttl.get(entity)
+        return ttl is None or time.time() - stored_at < ttl
+
+
+    def get_many(self, entity: str, ids: list) -> dict:
+        """Returns cached values of the IDs, keyed by ID. Expired and missing IDs are left out."""
+        found = {}
+        with self.lock:
+            not_in_memory = []
+            for id in ids:
+                entry = self.memory.get((entity, id))
+                if entry is not None and self.is_fresh(entity, entry[1]):
+                    self.memory.move_to_end((entity, id))
+                    found[id] = entry[0]
+                else:
+                    not_in_memory.append(id)
+
+            if self.db is not None and not_in_memory:
+                for batch_start in range(0, len(not_in_memory), 500):
+                    batch = not_in_memory[batch_start:batch_start + 500]
+                    placeholders = ",".join("?" * len(batch))
+                    rows = self.db.execute(
+                        f"SELECT id, value, stored_at FROM metadata WHERE entity = ? AND id IN ({placeholders})",
+                        [entity, *batch]
+                        ).fetchall()
+                    for id, value, stored_at in rows:
+                        if self.is_fresh(entity, stored_at):
+                            found[id] = json.loads(value)
+                            self.remember(entity, id, found[id], stored_at)
+
+            self.hits[entity] = self.hits.get(entity, 0) + len(found)
+            self.misses[entity] = self.misses.get(entity, 0) + len(ids) - len(found)
+
+        return found
+
+
+    def set_many(self, entity: str, values: dict) -> None:
+        """Stores values keyed by ID."""
+        stored_at = time.time()
+        with self.lock:
+            for id, value in values.items():
+                self.remember(entity, id, value, stored_at)
+            if self.db is not None:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)",
+                    [(entity, id, json.dumps(value), stored_at) for id, value in values.items()]
+                    )
+                self.db.commit()
+
+
+    def remember(self, entity: str, id: str, value, stored_at: float) -> None:
+        """Puts value into in-memory tier, evicting the least recently used entries."""
+        self.memory[(entity, id)] = (value, stored_at)
+        self.memory.move_to_end((entity, id))
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+
+    def stats(self) -> dict:
+        """Returns hit and miss counters per entity."""
+        with self.lock:
+            return {entity: {"hits": self.hits.get(entity, 0), "misses": self.misses.get(entity, 0)}
+                    for entity in set(self.hits) | set(self.misses)}
+
+
+    def close(self) -> None:
+        if self.db is not None:
+            self.db.close()
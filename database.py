@@ -1,31 +1,101 @@
+from __future__ import annotations
 import sys
-from datetime import date
+import io
+from datetime import date, datetime, timedelta
 import os
+import time
+import threading
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
 
 from psycopg2 import connect, sql
 from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
-from pandas.core.frame import DataFrame
-import pandas as pd
-import dotenv   
 
+import metrics
+
+if TYPE_CHECKING:
+    from pandas import DataFrame
+
+
+# User whose plays are loaded by single-user app.py.
+DEFAULT_USER = "default"
+# Names of environmental variables with database connection parameters.
+DB_PARAMS_KEYS = ["database", "user", "password", "host", "port"]
+
+
+def get_db_params() -> dict:
+    """Reads database parameters from environmental variables, loading .env file first.
+    Raises if any of them is missing."""
+    import dotenv
+    dotenv.load_dotenv()
+    missing = [key for key in DB_PARAMS_KEYS if key not in os.environ]
+    if missing:
+        raise Exception(f"Missing database parameters: {', '.join(missing)}. Put them in .env file.")
+
+    return {key: os.environ[key] for key in DB_PARAMS_KEYS}
 
-# Load database parameters as environmental variables.
-dotenv.load_dotenv()
 
 class Database:
+    """Connection to the PostgreSQL database.
+
+    By default the instance holds single connection. Pass max_connections to use
+    a thread-safe pool of min_connections to max_connections connections instead,
+    so that one instance can be shared by worker threads: each query borrows
+    a connection with get_cursor() or get_connection() and returns it afterwards.
+    Threads wait for a free connection when all of them are borrowed.
+    """
     connection = None
-    
-    DB_PARAMS = {
-                "database": os.environ["database"], 
-                "user": os.environ["user"], 
-                "password": os.environ["password"], 
-                "host": os.environ["host"], 
-                "port": os.environ["port"]
-                }
-
-    def __init__(self, params=DB_PARAMS) -> None:
+    pool = None
+    # Number of rows serialized into single COPY buffer.
+    COPY_CHUNK_SIZE = 100000
+    # load_batch copies tables of at least this many rows through a staging table 
+    # instead of sending them as VALUES, e.g. the chunks of a backfill.
+    COPY_MIN_ROWS = 1000
+    # OIDs of smallint, integer and bigint.
+    INTEGER_TYPES = {21, 23, 20}
+    # Tables in order of foreign key dependencies.
+    LOAD_ORDER = ["albums", "artists", "genres", "track_info", "artists_genres", "recent_tracks"]
+    # Columns of the unique constraints hit by ON CONFLICT DO NOTHING, per table.
+    CONFLICT_KEYS = {
+        "albums": ["album_id"],
+        "artists": ["artist_id"],
+        "genres": ["genre_name"],
+        "track_info": ["track_id"],
+        "artists_genres": ["artist_id", "genre_name"],
+        "recent_tracks": ["user_id", "played_at"]
+        }
+    # Rollup tables of listening statistics, updated by every load of recent_tracks.
+    STATS_TABLES = ["stats_daily", "stats_artists", "stats_genres", "stats_tracks"]
+    # Audio features averaged per day in stats_daily.
+    STATS_FEATURES = ["danceability", "energy", "speechiness", "acousticness", 
+                      "instrumentalness", "liveness", "valence", "tempo", "loudness"]
+    # recent_tracks is partitioned by month of played_at into tables named like this.
+    PARTITION_NAME = "recent_tracks_{:%Y_%m}"
+    # Pooled connection idle for longer than this number of seconds is checked 
+    # with "SELECT 1" before it is lent.
+    HEALTH_CHECK_INTERVAL = 30
+
+    def __init__(self, params: dict = None, max_connections: int = None, min_connections: int = 1) -> None:
+        """Connects with params, or with parameters read by get_db_params().
+        Exits on failure in single-connection mode and raises in pooled mode."""
+        if max_connections is not None:
+            self.connect_pool(params or get_db_params(), min_connections, max_connections)
+        else:
+            self.connect_single(params or get_db_params())
+        # Months of recent_tracks known to have a partition, None until checked 
+        # whether the table is partitioned at all.
+        self.partitions = None
+        self.partitions_lock = threading.Lock()
+        # Whether the rollup tables exist, None until checked.
+        self.stats_enabled = None
+
+
+    def connect_single(self, params: dict) -> None:
+        """Opens single connection in autocommit mode, exiting on failure."""
+
         try:
             self.connection = self.connect_to_db(params)
             self.connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
@@ -50,6 +120,69 @@ class Database:
         return conn
 
 
+    def connect_pool(self, params: dict, min_connections: int, max_connections: int) -> None:
+        """Opens pool of connections to the PostgreSQL database server."""
+        print(f"Connecting to the PostgreSQL database with up to {max_connections} connections...")
+        self.pool = ThreadedConnectionPool(min_connections, max_connections, **params)
+        # ThreadedConnectionPool raises when exhausted, the semaphore makes borrowers wait instead.
+        self.pool_slots = threading.BoundedSemaphore(max_connections)
+        self.returned_at = {}
+        print("Connection succesful.")
+
+
+    @contextmanager
+    def get_connection(self):
+        """Lends connection in autocommit mode. In pooled mode the connection is returned
+        to the pool afterwards, or closed and replaced if it turned out to be broken."""
+        if self.pool is None:
+            yield self.connection
+            return
+
+        with self.pool_slots:
+            conn = self.checkout()
+            broken = False
+            try:
+                yield conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                broken = True
+                raise
+            finally:
+                broken = broken or bool(conn.closed)
+                if broken:
+                    self.returned_at.pop(conn, None)
+                else:
+                    self.returned_at[conn] = time.monotonic()
+                self.pool.putconn(conn, close=broken)
+
+
+    def checkout(self) -> connection:
+        """Takes connection from the pool. Connection which was idle for longer than
+        HEALTH_CHECK_INTERVAL is checked first and replaced with a new one if it's dead."""
+        conn = self.pool.getconn()
+        idle = time.monotonic() - self.returned_at.get(conn, 0)
+        if conn.closed or idle > self.HEALTH_CHECK_INTERVAL:
+            try:
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                print("Reconnecting to the PostgreSQL database...")
+                self.returned_at.pop(conn, None)
+                self.pool.putconn(conn, close=True)
+                conn = self.pool.getconn()
+        conn.autocommit = True
+
+        return conn
+
+
+    @contextmanager
+    def get_cursor(self):
+        """Lends cursor of connection borrowed with get_connection()."""
+        with self.get_connection() as conn:
+            with conn.cursor() as cursor:
+                yield cursor
+
+
     # def create_database(self):
     #     """
     #     Execute a CREATE DATABASE request 
@@ -68,16 +201,27 @@ class Database:
     #             print(error)
 
 
-    def create_table(self, cols_dict: dict, table_name: str) -> None:
-        """Execute a single CREATE TABLE request."""
+    @staticmethod
+    def create_table_query(cols_dict: dict, table_name: str, partition_by: str = None) -> str:
+        """Returns CREATE TABLE IF NOT EXISTS statement. If partition_by is given 
+        (e.g. "RANGE (played_at)"), the table is created as partitioned."""
         cols_str = ", ".join([f"{key} {value}" for key, value in cols_dict.items()])
-        sql = f"CREATE TABLE IF NOT EXISTS {table_name} ({cols_str})"
+        query = f"CREATE TABLE IF NOT EXISTS {table_name} ({cols_str})"
+        if partition_by is not None:
+            query += f" PARTITION BY {partition_by}"
 
+        return query
+
+
+    def create_table(self, cols_dict: dict, table_name: str, partition_by: str = None) -> None:
+        """Execute a single CREATE TABLE request. Prints the error instead of raising;
+        migrations execute create_table_query() themselves, so that failures propagate."""
         try:
-            self.cursor.execute(sql)
+            with self.get_cursor() as cursor:
+                cursor.execute(self.create_table_query(cols_dict, table_name, partition_by))
             print(f"Table {table_name} created succesfully.")
         except (Exception, psycopg2.OperationalError) as error:
-            print(f"Table not created. Error code: {error.pgcode}")
+            print(f"Table not created. Error code: {getattr(error, 'pgcode', None)}. Error: {error}")
 
 
     # def alter_table(
@@ -97,6 +241,16 @@ class Database:
     #         print(f"Error ocured: {error}\nError code: {error.pgcode}")
 
 
+    def add_column(self, table_name: str, column: str, definition: str) -> None:
+        """Adds column to the existing table if it's missing."""
+        sql = f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS {column} {definition}"
+        try:
+            with self.get_cursor() as cursor:
+                cursor.execute(sql)
+        except(psycopg2.ProgrammingError) as error:
+            print(f"Error ocured: {error}\nError code: {error.pgcode}")
+
+
     def add_pk(self, table_name: str, constraint_name: str, column: str) -> None:
         """Sets PRIMARY KEY on the existing table."""
         try:
@@ -104,7 +258,8 @@ class Database:
             ALTER TABLE {table_name} DROP CONSTRAINT IF EXISTS {constraint_name} CASCADE;
             ALTER TABLE {table_name} ADD CONSTRAINT {constraint_name} PRIMARY KEY ({column});
             """
-            self.cursor.execute(sql)
+            with self.get_cursor() as cursor:
+                cursor.execute(sql)
         except(psycopg2.ProgrammingError) as error:
             print(f"Error ocured: {error}\nError code: {error.pgcode}")
 
@@ -123,7 +278,8 @@ class Database:
                 ALTER TABLE {table_name} ADD CONSTRAINT {constraint_name} FOREIGN KEY ({column}) REFERENCES {table_name_fk} ({column_fk});
                 """
         try:
-            self.cursor.execute(sql)
+            with self.get_cursor() as cursor:
+                cursor.execute(sql)
         except(psycopg2.ProgrammingError) as error:
             print(f"Error ocured: {error}\nError code: {error.pgcode}")
 
@@ -133,65 +289,588 @@ class Database:
         """Add UNIQUE constraint to assure unique values in column(s)."""
         sql = f"""ALTER TABLE {table_name} ADD CONSTRAINT {constraint_name} UNIQUE ({columns_str})"""
         try:
-            self.cursor.execute(sql)
+            with self.get_cursor() as cursor:
+                cursor.execute(sql)
         except(psycopg2.ProgrammingError) as error:
             print(f"Error ocured: {error}\nError code: {error.pgcode}")
             
 
+    def add_index(self, table_name: str, index_name: str, columns: str) -> None:
+        """Creates index if it's missing. Index on partitioned table is created on every partition."""
+        sql = f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({columns})"
+        try:
+            with self.get_cursor() as cursor:
+                cursor.execute(sql)
+        except(psycopg2.ProgrammingError) as error:
+            print(f"Error ocured: {error}\nError code: {error.pgcode}")
+
+
+    def is_partitioned(self, table_name: str) -> bool:
+        with self.get_cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", (table_name,))
+
+            return cursor.fetchone() is not None
+
+
+    @staticmethod
+    def partition_months(start: datetime, end: datetime) -> list:
+        """Returns first days of the months from start to end."""
+        months = []
+        month = date(start.year, start.month, 1)
+        while month <= end.date():
+            months.append(month)
+            month = (month + timedelta(days=31)).replace(day=1)
+
+        return months
+
+
+    def create_partition(self, cursor, month: date) -> None:
+        next_month = (month + timedelta(days=31)).replace(day=1)
+        cursor.execute(sql.SQL("""
+            CREATE TABLE IF NOT EXISTS {} PARTITION OF recent_tracks 
+            FOR VALUES FROM (%s) TO (%s)
+            """).format(sql.Identifier(self.PARTITION_NAME.format(month))), (month, next_month))
+
+
+    def ensure_partitions(self, start: datetime, end: datetime) -> None:
+        """Creates monthly partitions of recent_tracks covering start to end, if missing.
+        Does nothing if recent_tracks was not migrated to the partitioned layout."""
+        with self.partitions_lock:
+            if self.partitions is None:
+                self.partitions = set() if self.is_partitioned("recent_tracks") else False
+            if self.partitions is False:
+                return
+
+            missing = [month for month in self.partition_months(start, end) if month not in self.partitions]
+            if not missing:
+                return
+            with self.get_cursor() as cursor:
+                for month in missing:
+                    self.create_partition(cursor, month)
+            self.partitions.update(missing)
+
+
+    def ensure_partitions_for(self, data: DataFrame) -> None:
+        """Creates partitions of recent_tracks for the plays in data."""
+        import pandas as pd
+
+        played_at = pd.to_datetime(data["played_at"], utc=True)
+        self.ensure_partitions(played_at.min(), played_at.max())
+
+
+    def migrate_recent_tracks(self) -> None:
+        """Moves recent_tracks created by earlier versions into the partitioned layout, 
+        in single transaction. Constraints and indexes are added by setup afterwards."""
+        if self.is_partitioned("recent_tracks"):
+            return
+
+        print("Migrating recent_tracks to monthly partitions...")
+        with self.get_connection() as connection:
+            connection.autocommit = False
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute("""
+                        ALTER TABLE recent_tracks RENAME TO recent_tracks_unpartitioned;
+                        ALTER TABLE recent_tracks_unpartitioned DROP CONSTRAINT IF EXISTS played_at_pk CASCADE;
+                        CREATE TABLE recent_tracks (
+                            id bigserial,
+                            user_id TEXT NOT NULL DEFAULT %s,
+                            played_at timestamp NOT NULL,
+                            track_id TEXT,
+                            album_id TEXT,
+                            artist_id TEXT
+                            ) PARTITION BY RANGE (played_at);
+                        SELECT MIN(played_at), MAX(played_at) FROM recent_tracks_unpartitioned;
+                        """, (DEFAULT_USER,))
+                    start, end = cursor.fetchone()
+                    if start is not None:
+                        for month in self.partition_months(start, end):
+                            self.create_partition(cursor, month)
+                    cursor.execute("""
+                        INSERT INTO recent_tracks (user_id, played_at, track_id, album_id, artist_id)
+                        SELECT user_id, played_at, track_id, album_id, artist_id 
+                        FROM recent_tracks_unpartitioned
+                        ORDER BY played_at
+                        """)
+                    migrated = cursor.rowcount
+                    cursor.execute("DROP TABLE recent_tracks_unpartitioned")
+                connection.commit()
+                print(f"Migrated {migrated} plays.")
+            except (Exception, psycopg2.DatabaseError) as error:
+                print(f"Migration failed, rolling back. Error: {error}")
+                connection.rollback()
+                raise
+            finally:
+                connection.autocommit = True
+                self.partitions = None
+
+
     def insert_into_table(self, data: DataFrame, table_name: str) -> None:
-        """Inserts data into table."""
-        df_numpy = data.to_numpy()
-        df_tuples = [tuple(row) for row in list(df_numpy)]
+        """Inserts data into table. New plays are added to the rollup tables."""
+        # Rows are generated page by page instead of materializing them all at once.
+        df_tuples = data.itertuples(index=False, name=None)
         cols = ','.join(list(data.columns))
         query = "INSERT INTO {} ({}) VALUES %s ON CONFLICT DO NOTHING".format(table_name, cols)
-        try:
-            execute_values(self.cursor, query, df_tuples)
-            self.connection.commit()
-        except(psycopg2.IntegrityError) as error:
-            print(f"""Error occurred during insert into table {table_name}. 
-                      Error code: {error.pgcode}""")
-        except (Exception, psycopg2.DatabaseError) as error:
-            print(f"Error: {error}")
-            self.connection.rollback()
+        rollup = table_name == "recent_tracks" and self.has_stats()
+        if rollup:
+            query = self.stats_rollup_insert_query(query)
+        if table_name == "recent_tracks" and not data.empty:
+            self.ensure_partitions_for(data)
+        with self.get_connection() as connection:
+            try:
+                with connection.cursor() as cursor, metrics.registry.timer("db_insert_seconds", table=table_name):
+                    execute_values(cursor, query, df_tuples, fetch=rollup)
+                connection.commit()
+            except(psycopg2.IntegrityError) as error:
+                print(f"""Error occurred during insert into table {table_name}. 
+                          Error code: {error.pgcode}""")
+            except (Exception, psycopg2.DatabaseError) as error:
+                print(f"Error: {error}")
+                connection.rollback()
+
+
+    def stats_rollup_query(self, plays: str, new_plays: str = "") -> str:
+        """Returns statement which adds plays to the rollup tables and selects their number.
+        `plays` is the table (or CTE) with user_id, played_at, track_id and artist_id of the 
+        plays; `new_plays` is an optional CTE defining it, e.g. INSERT ... RETURNING."""
+        features = self.STATS_FEATURES
+        feature_cols = ", ".join(f"{feature}_sum" for feature in features)
+        feature_sums = ", ".join(f"COALESCE(SUM({feature}), 0)" for feature in features)
+        feature_updates = ", ".join(f"{feature}_sum = stats_daily.{feature}_sum + EXCLUDED.{feature}_sum" 
+                                    for feature in features)
+        track_features = ", ".join(f"t.{feature}" for feature in features)
+
+        return f"""
+            WITH {new_plays}
+            plays AS (
+                SELECT p.user_id, p.played_at, p.track_id, p.artist_id, t.duration_ms, {track_features}
+                FROM {plays} p
+                LEFT JOIN track_info t ON t.track_id = p.track_id
+            ),
+            daily AS (
+                INSERT INTO stats_daily (user_id, day, plays, listened_ms, feature_plays, {feature_cols})
+                SELECT user_id, played_at::date, COUNT(*), COALESCE(SUM(duration_ms), 0), 
+                       COUNT({features[0]}), {feature_sums}
+                FROM plays
+                GROUP BY 1, 2
+                ON CONFLICT (user_id, day) DO UPDATE SET
+                    plays = stats_daily.plays + EXCLUDED.plays,
+                    listened_ms = stats_daily.listened_ms + EXCLUDED.listened_ms,
+                    feature_plays = stats_daily.feature_plays + EXCLUDED.feature_plays,
+                    {feature_updates}
+            ),
+            artists AS (
+                INSERT INTO stats_artists (user_id, artist_id, plays, listened_ms, last_played_at)
+                SELECT user_id, artist_id, COUNT(*), COALESCE(SUM(duration_ms), 0), MAX(played_at)
+                FROM plays
+                WHERE artist_id IS NOT NULL
+                GROUP BY 1, 2
+                ON CONFLICT (user_id, artist_id) DO UPDATE SET
+                    plays = stats_artists.plays + EXCLUDED.plays,
+                    listened_ms = stats_artists.listened_ms + EXCLUDED.listened_ms,
+                    last_played_at = GREATEST(stats_artists.last_played_at, EXCLUDED.last_played_at)
+            ),
+            genres AS (
+                INSERT INTO stats_genres (user_id, genre_name, plays, listened_ms)
+                SELECT p.user_id, ag.genre_name, COUNT(*), COALESCE(SUM(p.duration_ms), 0)
+                FROM plays p
+                JOIN artists_genres ag ON ag.artist_id = p.artist_id
+                GROUP BY 1, 2
+                ON CONFLICT (user_id, genre_name) DO UPDATE SET
+                    plays = stats_genres.plays + EXCLUDED.plays,
+                    listened_ms = stats_genres.listened_ms + EXCLUDED.listened_ms
+            ),
+            tracks AS (
+                INSERT INTO stats_tracks (user_id, track_id, plays, listened_ms, last_played_at)
+                SELECT user_id, track_id, COUNT(*), COALESCE(SUM(duration_ms), 0), MAX(played_at)
+                FROM plays
+                WHERE track_id IS NOT NULL
+                GROUP BY 1, 2
+                ON CONFLICT (user_id, track_id) DO UPDATE SET
+                    plays = stats_tracks.plays + EXCLUDED.plays,
+                    listened_ms = stats_tracks.listened_ms + EXCLUDED.listened_ms,
+                    last_played_at = GREATEST(stats_tracks.last_played_at, EXCLUDED.last_played_at)
+            )
+            SELECT COUNT(*) FROM plays
+            """
+
+
+    def stats_rollup_insert_query(self, insert_query: str) -> str:
+        """Returns statement which runs INSERT INTO recent_tracks ... ON CONFLICT DO NOTHING, 
+        adds the inserted plays to the rollup tables and selects their number. Only the plays
+        returned by INSERT are new, skipped ones are already counted."""
+        return self.stats_rollup_query("new_plays", 
+            f"new_plays AS ({insert_query} RETURNING user_id, played_at, track_id, artist_id),")
+
+
+    def has_stats(self) -> bool:
+        """Returns whether the rollup tables were created by the migrations."""
+        if self.stats_enabled is None:
+            with self.get_cursor() as cursor:
+                cursor.execute("SELECT to_regclass('stats_daily') IS NOT NULL")
+                self.stats_enabled = cursor.fetchone()[0]
+
+        return self.stats_enabled
+
+
+    def refresh_stats(self) -> int:
+        """Rebuilds the rollup tables from all plays in single transaction. The loaders
+        update them incrementally, so this is needed only after plays are changed directly
+        in the database. Returns the number of aggregated plays."""
+        with self.get_connection() as connection:
+            connection.autocommit = False
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(f"TRUNCATE {', '.join(self.STATS_TABLES)}")
+                    cursor.execute(self.stats_rollup_query("recent_tracks"))
+                    plays = cursor.fetchone()[0]
+                connection.commit()
+            except (Exception, psycopg2.DatabaseError) as error:
+                print(f"Statistics refresh failed, rolling back. Error: {error}")
+                connection.rollback()
+                raise
+            finally:
+                connection.autocommit = True
+
+        return plays
+
+
+    def in_lock_order(self, data: DataFrame, table_name: str) -> DataFrame:
+        """Drops rows with duplicate conflict key and sorts the rest by it. Concurrent
+        loads then lock the shared rows of artists, albums etc. in the same order
+        and can't deadlock waiting on each other's uncommitted inserts."""
+        key = [column for column in self.CONFLICT_KEYS[table_name] if column in data.columns]
+        data = data.drop_duplicates(subset=key)
+
+        # Sorted by value, also categoricals, whose category order may differ between frames.
+        return data.sort_values(key, key=lambda column: column.astype(str))
+
+
+    def load_batch(self, frames: dict) -> dict:
+        """Loads DataFrames keyed by table name in single transaction, in LOAD_ORDER.
+        Each table is loaded with single INSERT statement, in order of its conflict key,
+        from VALUES or, with at least COPY_MIN_ROWS rows, from a staging table filled by COPY.
+        If any insert fails, nothing is loaded. Newly inserted plays are added to the rollup
+        tables in the same statement as recent_tracks. Returns numbers of inserted and skipped rows per table."""
+        unknown_tables = set(frames) - set(self.LOAD_ORDER)
+        if unknown_tables:
+            raise Exception(f"Unknown tables: {', '.join(unknown_tables)}")
+        # Partitions are created outside of the transaction, so that they are kept 
+        # (and cached) even if the load is rolled back.
+        if frames.get("recent_tracks") is not None and not frames["recent_tracks"].empty:
+            self.ensure_partitions_for(frames["recent_tracks"])
+
+        report = {}
+        has_stats = self.has_stats()
+        with metrics.stage("load"), self.get_connection() as connection:
+            connection.autocommit = False
+            try:
+                with connection.cursor() as cursor:
+                    for table_name in self.LOAD_ORDER:
+                        data = frames.get(table_name)
+                        if data is None or data.empty:
+                            continue
+                        n_rows = len(data)
+                        data = self.in_lock_order(data, table_name)
+                        rollup = table_name == "recent_tracks" and has_stats
+                        with metrics.registry.timer("db_insert_seconds", table=table_name):
+                            if len(data) >= self.COPY_MIN_ROWS:
+                                inserted = self.staged_insert(cursor, data, table_name, rollup)
+                            else:
+                                inserted = self.values_insert(cursor, data, table_name, rollup)
+                        report[table_name] = {"inserted": inserted, "skipped": n_rows - inserted}
+                connection.commit()
+                for table_name, counts in report.items():
+                    metrics.inc("db_rows_inserted_total", counts["inserted"], table=table_name)
+                    metrics.inc("db_rows_skipped_total", counts["skipped"], table=table_name)
+            except (Exception, psycopg2.DatabaseError) as error:
+                print(f"Batch load failed, rolling back. Error: {error}")
+                metrics.inc("db_batch_errors_total")
+                if not connection.closed:
+                    connection.rollback()
+                raise
+            finally:
+                if not connection.closed:
+                    connection.autocommit = True
+
+        return report
+
+
+    def values_insert(self, cursor, data: DataFrame, table_name: str, rollup: bool = False) -> int:
+        """Inserts data with single INSERT ... VALUES ... ON CONFLICT DO NOTHING. If rollup 
+        is true, inserted plays are added to the rollup tables. Returns the number of inserted rows."""
+        cols = sql.SQL(", ").join(map(sql.Identifier, data.columns))
+        query = sql.SQL("INSERT INTO {} ({}) VALUES %s ON CONFLICT DO NOTHING").format(
+            sql.Identifier(table_name), cols
+            ).as_string(cursor)
+        if rollup:
+            query = self.stats_rollup_insert_query(query)
+        # Single page, so that the whole table is sent in one round trip.
+        result = execute_values(cursor, query, data.itertuples(index=False, name=None), 
+                                page_size=len(data), fetch=rollup)
+
+        return result[0][0] if rollup else cursor.rowcount
+
+
+    def staged_insert(self, cursor, data: DataFrame, table_name: str, rollup: bool = False, 
+                      chunk_size: int = None) -> int:
+        """Streams data with COPY into temporary staging table of the session and moves it
+        into the table with single INSERT ... SELECT ... ON CONFLICT DO NOTHING. If rollup 
+        is true, inserted plays are added to the rollup tables. Returns the number of inserted rows."""
+        chunk_size = chunk_size or self.COPY_CHUNK_SIZE
+        staging = sql.Identifier(f"staging_{table_name}")
+        table = sql.Identifier(table_name)
+        cols = sql.SQL(", ").join(map(sql.Identifier, data.columns))
+        # Missing values are written as \N, so that they are not confused with empty strings.
+        copy_query = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')").format(staging, cols)
+        cursor.execute(sql.SQL("""
+            DROP TABLE IF EXISTS {staging};
+            CREATE TEMP TABLE {staging} AS SELECT {cols} FROM {table} WITH NO DATA;
+            SELECT * FROM {staging} LIMIT 0
+            """).format(staging=staging, cols=cols, table=table))
+        # Integer columns with missing values are float in pandas. Unlike INSERT, COPY
+        # doesn't accept "50.0" for an integer, so they are written without decimals.
+        integer_cols = [column.name for column in cursor.description 
+                        if column.type_code in self.INTEGER_TYPES and data[column.name].dtype.kind == "f"]
+        data = data.astype({column: "Int64" for column in integer_cols})
+        # Copy in chunks to keep the CSV buffer bounded.
+        for start in range(0, len(data), chunk_size):
+            buffer = io.StringIO()
+            data.iloc[start:start + chunk_size].to_csv(buffer, index=False, header=False, na_rep="\\N")
+            buffer.seek(0)
+            cursor.copy_expert(copy_query, buffer)
+        # Temporary tables are never scanned in parallel, so rows are inserted in the
+        # order they were copied in, i.e. in load_batch's lock order.
+        query = sql.SQL("""
+            INSERT INTO {table} ({cols}) SELECT {cols} FROM {staging} ON CONFLICT DO NOTHING
+            """).format(staging=staging, cols=cols, table=table).as_string(cursor)
+        if rollup:
+            cursor.execute(self.stats_rollup_insert_query(query))
+            inserted = cursor.fetchone()[0]
+        else:
+            cursor.execute(query)
+            inserted = cursor.rowcount
+        cursor.execute(sql.SQL("DROP TABLE {}").format(staging))
+
+        return inserted
+
+
+    def bulk_insert_into_table(self, data: DataFrame, table_name: str, chunk_size: int = None) -> int:
+        """Streams data with COPY into temporary staging table and moves it into the table 
+        with single INSERT ... SELECT ... ON CONFLICT DO NOTHING. Suited for large backfills.
+        New plays are added to the rollup tables by the same statement. Returns the number of inserted rows. Raises on failure, so that a failed COPY is
+        not mistaken for rows which were already present."""
+        inserted = 0
+        rollup = table_name == "recent_tracks" and self.has_stats()
+        if table_name == "recent_tracks" and not data.empty:
+            self.ensure_partitions_for(data)
+        # Temporary table lives in the session, so all statements run on one connection.
+        with self.get_connection() as connection:
+            try:
+                with connection.cursor() as cursor:
+                    inserted = self.staged_insert(cursor, data, table_name, rollup, chunk_size)
+            except (Exception, psycopg2.DatabaseError) as error:
+                print(f"Error occurred during bulk insert into table {table_name}: {error}")
+                if not connection.closed:
+                    connection.rollback()
+                raise
+
+        return inserted
+
+
+    def get_last_played_at(self, user_id: str = DEFAULT_USER) -> datetime:
+        """Returns the time (UTC) of the user's latest loaded play, or None if there is none."""
+        with self.get_cursor() as cursor:
+            cursor.execute("SELECT MAX(played_at) FROM recent_tracks WHERE user_id = %s", (user_id,))
+
+            return cursor.fetchone()[0]
+
+
+    def get_played_tracks(self, user_id: str, start: datetime, end: datetime) -> set:
+        """Returns (played_at truncated to the second, track_id) of the user's plays
+        between start and end (UTC, inclusive, to the second)."""
+        query = """
+                SELECT date_trunc('second', played_at), track_id
+                FROM recent_tracks
+                WHERE user_id = %s
+                  AND played_at >= %s
+                  AND played_at < %s + interval '1 second'
+                """
+        with self.get_cursor() as cursor:
+            cursor.execute(query, (user_id, start, end))
+
+            return set(cursor.fetchall())
+
+
+    def get_artist_data(self, artist_ids: list) -> DataFrame:
+        """Reads popularity, followers and comma-separated genres of the artists
+        which are already stored in the database."""
+        import pandas as pd
+
+        query = """
+                SELECT a.artist_id,
+                       a.artist_popularity,
+                       a.followers,
+                       COALESCE(string_agg(ag.genre_name, ',' ORDER BY ag.id), '') AS artist_genres
+                FROM artists a
+                LEFT JOIN artists_genres ag ON ag.artist_id = a.artist_id
+                WHERE a.artist_id = ANY(%s)
+                  AND a.artist_popularity IS NOT NULL
+                GROUP BY a.artist_id, a.artist_popularity, a.followers
+                """
+        with self.get_cursor() as cursor:
+            cursor.execute(query, (list(artist_ids),))
+            rows = cursor.fetchall()
+
+        return pd.DataFrame(rows, columns=["artist_id", "artist_popularity", "followers", "artist_genres"])
+
+
+    def get_track_features(self, track_ids: list, features: list) -> DataFrame:
+        """Reads audio features of the tracks which are already stored in the database."""
+        import pandas as pd
+
+        query = sql.SQL("SELECT track_id, {features} FROM track_info WHERE track_id = ANY(%s)").format(
+            features=sql.SQL(", ").join(
+                sql.SQL("{}::float").format(sql.Identifier(feature)) for feature in features
+                )
+            )
+        with self.get_cursor() as cursor:
+            cursor.execute(query, (list(track_ids),))
+            rows = cursor.fetchall()
+
+        return pd.DataFrame(rows, columns=["track_id"] + features)
+
+
+    def query_df(self, query, params: tuple = None) -> DataFrame:
+        """Runs the query and returns its rows as DataFrame."""
+        import pandas as pd
+
+        with self.get_cursor() as cursor:
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            columns = [column.name for column in cursor.description]
+
+        return pd.DataFrame(rows, columns=columns)
+
+
+    def get_daily_stats(self, user_id: str = DEFAULT_USER, start: date = None, end: date = None) -> DataFrame:
+        """Returns plays, listened minutes and average audio features of the user per day
+        from start to end (inclusive), read from the rollups."""
+        averages = ", ".join(
+            f"ROUND({feature}_sum / NULLIF(feature_plays, 0), 3)::float AS {feature}" 
+            for feature in self.STATS_FEATURES
+            )
+        query = f"""
+                SELECT day, plays, ROUND(listened_ms / 60000.0, 1)::float AS listened_minutes, {averages}
+                FROM stats_daily
+                WHERE user_id = %s
+                  AND day >= COALESCE(%s, '-infinity'::date)
+                  AND day <= COALESCE(%s, 'infinity'::date)
+                ORDER BY day
+                """
+
+        return self.query_df(query, (user_id, start, end))
+
+
+    def get_top_artists(self, user_id: str = DEFAULT_USER, limit: int = 10) -> DataFrame:
+        """Returns the user's most played artists, read from the rollups."""
+        query = """
+                SELECT s.artist_id, a.artist_name, s.plays, 
+                       ROUND(s.listened_ms / 60000.0, 1)::float AS listened_minutes, s.last_played_at
+                FROM stats_artists s
+                LEFT JOIN artists a ON a.artist_id = s.artist_id
+                WHERE s.user_id = %s
+                ORDER BY s.plays DESC
+                LIMIT %s
+                """
+
+        return self.query_df(query, (user_id, limit))
+
+
+    def get_top_genres(self, user_id: str = DEFAULT_USER, limit: int = 10) -> DataFrame:
+        """Returns the user's most played genres, read from the rollups. A play counts
+        towards every genre of its artist."""
+        query = """
+                SELECT genre_name, plays, ROUND(listened_ms / 60000.0, 1)::float AS listened_minutes
+                FROM stats_genres
+                WHERE user_id = %s
+                ORDER BY plays DESC
+                LIMIT %s
+                """
+
+        return self.query_df(query, (user_id, limit))
+
+
+    def get_top_tracks(self, user_id: str = DEFAULT_USER, limit: int = 10) -> DataFrame:
+        """Returns the user's most played tracks, read from the rollups."""
+        query = """
+                SELECT s.track_id, t.track_name, s.plays, 
+                       ROUND(s.listened_ms / 60000.0, 1)::float AS listened_minutes, s.last_played_at
+                FROM stats_tracks s
+                LEFT JOIN track_info t ON t.track_id = s.track_id
+                WHERE s.user_id = %s
+                ORDER BY s.plays DESC
+                LIMIT %s
+                """
+
+        return self.query_df(query, (user_id, limit))
+
+
+    def get_play_counts(self, day: date) -> tuple:
+        """Returns the number of plays of all users on the day and in total, read from the rollups."""
+        with self.get_cursor() as cursor:
+            cursor.execute("""
+                SELECT COALESCE(SUM(plays) FILTER (WHERE day = %s), 0), COALESCE(SUM(plays), 0)
+                FROM stats_daily
+                """, (day,))
+
+            return cursor.fetchone()
 
 
     def count_records(self) -> None:
         """
         Counts records added to the database in the current date 
-        and the overall number of records in the database.
+        and the overall number of records in the database. 
+        Counts are read from the rollups if they exist.
         """
+        if self.has_stats():
+            today_records, records = self.get_play_counts(date.today())
+            print(f"You have listened to {today_records} records today.")
+            print(f"Your listening history contains {records} records in total.")
+            return
+
         query = "SELECT COUNT(*) FROM recent_tracks"
-        try:
-            self.cursor.execute(query)
-        except (Exception, psycopg2.DatabaseError) as error:
-            print(f"Query could not be executed. Error code: {error}")
-
-        records = self.cursor.fetchall()
-
-        today_records_query = f"""
-                                SELECT COUNT(*)
-                                FROM recent_tracks 
-                                WHERE EXTRACT(YEAR FROM played_at) 
-                                   || '-' 
-                                   || EXTRACT(MONTH FROM played_at) 
-                                   || '-' 
-                                   || EXTRACT(DAY FROM played_at) = '{str(date.today()).replace('-0', '-')}'
-                                """
-        
-        try:
-            self.cursor.execute(today_records_query)
-        except (Exception, psycopg2.DatabaseError) as error:
-            print(f"Query could not be executed. Error code: {error}")
-        
-        today_records = self.cursor.fetchall()
+        # Range predicate on played_at can use the index and prune partitions.
+        today_records_query = "SELECT COUNT(*) FROM recent_tracks WHERE played_at >= %s AND played_at < %s"
+        today = date.today()
+        with self.get_cursor() as cursor:
+            try:
+                cursor.execute(query)
+                records = cursor.fetchall()
+                cursor.execute(today_records_query, (today, today + timedelta(days=1)))
+                today_records = cursor.fetchall()
+            except (Exception, psycopg2.DatabaseError) as error:
+                print(f"Query could not be executed. Error code: {error}")
+                return
+
         print(f"You have listened to {today_records[0][0]} records today.")
         print(f"Your listening history contains {records[0][0]} records in total.")
 
 
-    def __del__(self) -> None:
-        try:
+    def close(self) -> None:
+        """Closes the connection, or all connections of the pool."""
+        if self.pool is not None:
+            self.pool.closeall()
+            self.pool = None
+        elif self.connection is not None:
             self.cursor.close()
             self.connection.close()
+            self.connection = None
+
+
+    def __del__(self) -> None:
+        try:
+            self.close()
         except AttributeError as error:
             print(f"""{error}.\nIt seems that connection to the database 
                       could not be established.""")
@@ -199,89 +878,11 @@ class Database:
 if __name__ == "__main__":
 
     # If you run "python database.py setup", the program will connect 
-    # to the database and create all tables and constraints.
+    # to the database and apply pending schema migrations (see migrations.py), 
+    # creating all tables and constraints on the first run.
 
     if len(sys.argv) > 1 and sys.argv[1] == "setup":
+        import migrations
 
         db_spotify = Database()
-        # Define columns in the database tables.
-        recent_track_cols = {
-            "id": "integer GENERATED ALWAYS AS IDENTITY",
-            "played_at": "timestamp",
-            "track_id" :"TEXT", 
-            "album_id" : "TEXT",
-            "artist_id": "TEXT"
-            }
-
-        albums_cols = {
-            "id": "integer GENERATED ALWAYS AS IDENTITY",
-            "album_id": "TEXT",
-            "album_name": "TEXT",
-            "album_release_date": "timestamp"
-            }
-
-        artists_cols = {
-            "id": "integer GENERATED ALWAYS AS IDENTITY",
-            "artist_id": "TEXT",
-            "artist_name": "TEXT",
-            "artist_popularity": "integer",
-            "followers": "integer"
-        }
-
-        genres_cols = {
-            "id": "integer GENERATED ALWAYS AS IDENTITY",
-            "genre_name": "TEXT"
-        }
-
-        artists_genres_cols = {
-            "id": "integer GENERATED ALWAYS AS IDENTITY",
-            "artist_id": "TEXT",
-            "genre_name": "TEXT"
-        }
-
-        track_info_cols = {
-            "id": "integer GENERATED ALWAYS AS IDENTITY",
-            "track_id": "TEXT",
-            "track_name": "TEXT",
-            "track_popularity": "integer",
-            "danceability": "decimal",
-            "energy": "decimal",
-            "key": "decimal", 
-            "loudness": "decimal",
-            "mode": "decimal",
-            "speechiness": "decimal",
-            "acousticness": "decimal",
-            "instrumentalness": "decimal",
-            "liveness": "decimal",
-            "valence": "decimal",
-            "tempo": "decimal",
-            "duration_ms": "integer",
-            "time_signature": "integer",
-            "is_explicit": "bool"
-        }
-
-        # Create tables in the database.
-        db_spotify.create_table(recent_track_cols, "recent_tracks")
-        db_spotify.create_table(albums_cols, "albums")
-        db_spotify.create_table(artists_cols, "artists") 
-        db_spotify.create_table(genres_cols, "genres")
-        db_spotify.create_table(artists_cols, "artists")
-        db_spotify.create_table(artists_genres_cols, "artists_genres")
-        db_spotify.create_table(track_info_cols, "track_info")
-
-        # Add Primary Keys.
-        db_spotify.add_pk("albums", "album_id_pk", "album_id")
-        db_spotify.add_pk("artists", "artist_id_pk", "artist_id")
-        db_spotify.add_pk("genres", "genre_name_pk", "genre_name")
-        db_spotify.add_pk("track_info", "track_id_pk", "track_id")
-        db_spotify.add_pk("recent_tracks", "played_at_pk", "played_at")
-
-        # Add Foreign Keys.
-        db_spotify.add_fk("recent_tracks", "track_id_fk", "track_id", "track_info", "track_id")
-        db_spotify.add_fk("recent_tracks", "album_id_fk", "album_id", "albums", "album_id")
-        db_spotify.add_fk("recent_tracks", "artist_id_fk", "artist_id", "artists", "artist_id")
-        db_spotify.add_fk("artists_genres", "artist_id_fk", "artist_id", "artists", "artist_id")
-        db_spotify.add_fk("artists_genres", "genre_name_fk", "genre_name", "genres", "genre_name")
-
-        # Add UNIQUE constraint.
-        db_spotify.add_constraint_unique("artists_genres", "unique_artist_genre", ["artist_id", "genre_name"])
\ No newline at end of file
+        migrations.run_migrations(db_spotify)
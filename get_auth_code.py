@@ -2,12 +2,14 @@ import base64
 import datetime
 import webbrowser
 import json
+import threading
 import requests
 import os 
-from flask import Flask, redirect, request
 from urllib.parse import urlencode
 import dotenv
 
+import http_session
+
 
 # Spotify URLs
 SPOTIFY_AUTH_URL = "https://accounts.spotify.com/authorize"
@@ -27,7 +29,12 @@ SHOW_DIALOG = "false"
 # Load Client ID and Client Secret as environmental variables.
 dotenv.load_dotenv()
 
-app = Flask(__name__)
+# Flask app serving the authorization flow, created by create_app() only when
+# the authorization code is missing, so that Flask is not imported otherwise.
+app = None
+
+_token_manager = None
+_token_manager_lock = threading.Lock()
 
 class JSON_handler:
 
@@ -73,8 +80,99 @@ class JSON_handler:
         cur_dir = os.path.dirname(os.path.abspath(__file__))
         file_dir = os.path.join(cur_dir, cls.SECRETS_FILE)
 
-        with open(file_dir, mode="w", encoding="utf-8") as f:
-            json.dump(secrets_json, f, indent=0)
+        write_json_atomic(file_dir, secrets_json)
+
+
+def write_json_atomic(path: str, content: dict) -> None:
+    """Writes JSON into temporary file and moves it in place, so that readers 
+    never see half-written file."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, mode="w", encoding="utf-8") as f:
+        json.dump(content, f, indent=0)
+    os.replace(tmp_path, path)
+
+
+class TokenManager:
+    """Keeps the tokens of one account in memory and refreshes the access token 
+    REFRESH_MARGIN seconds ahead of expiry, in a background timer thread.
+
+    The token file is read once and written atomically after each refresh.
+    The manager can be shared by threads: only one of them refreshes the token,
+    the others wait for the result.
+    """
+
+    # Seconds before expiration when the token is refreshed.
+    REFRESH_MARGIN = 300
+    # Seconds before retrying failed background refresh.
+    RETRY_INTERVAL = 30
+
+    def __init__(self, token_file: str = None, background: bool = True) -> None:
+        if token_file is None:
+            token_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), JSON_handler.SECRETS_FILE)
+        self.token_file = token_file
+        self.background = background
+        self.lock = threading.Lock()
+        self.timer = None
+        with open(token_file, encoding="utf-8") as f:
+            self.token_data = json.load(f)
+        if background:
+            self.schedule_refresh()
+
+
+    def expires_at(self) -> datetime.datetime:
+        return datetime.datetime.strptime(self.token_data["expires_at"], "%m/%d/%Y, %H:%M:%S")
+
+
+    def needs_refresh(self) -> bool:
+        refresh_at = self.expires_at() - datetime.timedelta(seconds=self.REFRESH_MARGIN)
+        return datetime.datetime.now() >= refresh_at
+
+
+    def get_token(self) -> str:
+        """Returns cached access token, refreshing it first if it's about to expire."""
+        with self.lock:
+            if self.needs_refresh():
+                self.refresh()
+            return self.token_data["access_token"]
+
+
+    def refresh(self) -> None:
+        """Refreshes the access token and persists it. Must be called with the lock held."""
+        self.token_data.update(refresh_access_token(self.token_data["refresh_token"]))
+        write_json_atomic(self.token_file, self.token_data)
+        if self.background:
+            self.schedule_refresh()
+
+
+    def schedule_refresh(self, delay: float = None) -> None:
+        """Starts timer which refreshes the token REFRESH_MARGIN seconds before it expires."""
+        if delay is None:
+            refresh_at = self.expires_at() - datetime.timedelta(seconds=self.REFRESH_MARGIN)
+            delay = max((refresh_at - datetime.datetime.now()).total_seconds(), 0)
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = threading.Timer(delay, self.refresh_in_background)
+        self.timer.daemon = True
+        self.timer.start()
+
+
+    def refresh_in_background(self) -> None:
+        with self.lock:
+            # The token could have been refreshed by get_token in the meantime.
+            if not self.needs_refresh():
+                return
+            try:
+                self.refresh()
+                print("Token has been refreshed.")
+            except Exception as error:
+                print(f"Background token refresh failed: {error}")
+                self.schedule_refresh(self.RETRY_INTERVAL)
+
+
+    def stop(self) -> None:
+        """Cancels the background refresh."""
+        if self.timer is not None:
+            self.timer.cancel()
 
    
 
@@ -99,6 +197,8 @@ def extract_auth_code() -> str:
     Returns:
         str: returns authorization code extracted from the URL
     """
+    from flask import request
+
     auth_code = request.args["code"]
     _ = requests.get(f"{CLIENT_SIDE_URL}:{PORT}/shutdown")
 
@@ -119,7 +219,7 @@ def obtain_auth_code() -> str:
     """
     if JSON_handler.json_not_contains("authorization_code"):
         webbrowser.open_new(f"{CLIENT_SIDE_URL}:{PORT}")
-        app.run(debug=False, port=PORT)
+        create_app().run(debug=False, port=PORT)
     
     secrets_dict = JSON_handler.read()
     
@@ -137,20 +237,25 @@ def get_client_creds_b64() -> str:
     return client_creds_b64.decode()
 
 
+def get_token_manager() -> TokenManager:
+    """Returns the process-wide TokenManager of secrets.json, creating it on first use."""
+    global _token_manager
+    with _token_manager_lock:
+        if _token_manager is None:
+            _token_manager = TokenManager()
+
+    return _token_manager
+
+
 def get_token() -> str:
-    """"Requests new token if one is missing from secrets.json file 
-        or refreshes the token if it's expired."""
-    if JSON_handler.json_not_contains("access_token"):
-        request_token()
-        print("New token obtained.")
-    if is_token_expired():
-        refresh_token()
-        print("Token has been refreshed.")
+    """"Requests new token if one is missing from secrets.json file. Returns the token 
+        cached by TokenManager, which refreshes it before it expires."""
+    with _token_manager_lock:
+        if _token_manager is None and JSON_handler.json_not_contains("access_token"):
+            request_token()
+            print("New token obtained.")
     
-    token_data = JSON_handler.read()
-    access_token = token_data["access_token"]
-    
-    return access_token
+    return get_token_manager().get_token()
     
 
 def request_token() -> str:
@@ -163,7 +268,7 @@ def request_token() -> str:
         "redirect_uri": REDIRECT_URI
     }
     headers = {"Authorization": f"Basic {client_creds_b64}"}
-    r = requests.post(SPOTIFY_TOKEN_URL, data=data, headers=headers)
+    r = http_session.get_default_session().post(SPOTIFY_TOKEN_URL, data=data, headers=headers)
     if r.status_code not in range(200, 299):
         print(r.json())
         raise Exception(f"Authentication failed. Request status code: {r.status_code}")
@@ -179,55 +284,75 @@ def request_token() -> str:
 def refresh_token() -> None:
     """Refreshes token and updates it in the secrets.json file."""
     token_data = JSON_handler.read()
-    refresh_token = token_data["refresh_token"]
-    client_credentials = get_client_creds_b64()
+    token_data.update(refresh_access_token(token_data["refresh_token"]))
+
+    JSON_handler.write(token_data)
+
+
+def refresh_access_token(refresh_token: str) -> dict:
+    """Requests new access token with the refresh token. Returns new token data 
+    with expiration time, keeping the refresh token if Spotify didn't rotate it."""
     data = {
         "grant_type": "refresh_token",
         "refresh_token": refresh_token
     }
     headers = {
-        "Authorization": f"Basic {client_credentials}"
+        "Authorization": f"Basic {get_client_creds_b64()}"
     }
 
-    r = requests.post(SPOTIFY_TOKEN_URL, data=data, headers=headers)
-    new_token_data = r.json()
-    refreshed_token = new_token_data["access_token"]
-    token_data["access_token"] = refreshed_token
+    r = http_session.get_default_session().post(SPOTIFY_TOKEN_URL, data=data, headers=headers)
+    if r.status_code not in range(200, 299):
+        print(r.json())
+        raise Exception(f"Token refresh failed. Request status code: {r.status_code}")
+    token_data = r.json()
+    token_data.setdefault("refresh_token", refresh_token)
     token_expiration_time = datetime.datetime.now() + datetime.timedelta(seconds=token_data["expires_in"])
-    token_expiration_time = token_expiration_time.strftime("%m/%d/%Y, %H:%M:%S")
-    token_data["expires_at"] = token_expiration_time
+    token_data["expires_at"] = token_expiration_time.strftime("%m/%d/%Y, %H:%M:%S")
 
-    JSON_handler.write(token_data)
+    return token_data
 
 
-# Flask app
-@app.route("/")
-def index() -> redirect:
-    auth_query_parameters = {
-    "response_type": "code",
-    "redirect_uri": REDIRECT_URI,
-    "scope": SCOPE,
-    # "state": STATE,
-    "show_dialog": SHOW_DIALOG,
-    "client_id": os.environ["CLIENT_ID"]
-}
-    auth_url_params = f"{SPOTIFY_AUTH_URL}?{urlencode(auth_query_parameters)}"
-    return redirect(auth_url_params)
-
-
-@app.route("/callback/q")
-def callback():
-    return request_token()
-    
- 
-@app.route('/shutdown', methods=['GET'])
-def shutdown():
-    shutdown_server()
-    return 'Server shutting down...'
+def create_app():
+    """Creates the Flask app with the authorization routes, importing Flask on first use."""
+    global app
+    if app is not None:
+        return app
+
+    from flask import Flask, redirect
+
+    app = Flask(__name__)
+
+    @app.route("/")
+    def index() -> redirect:
+        auth_query_parameters = {
+        "response_type": "code",
+        "redirect_uri": REDIRECT_URI,
+        "scope": SCOPE,
+        # "state": STATE,
+        "show_dialog": SHOW_DIALOG,
+        "client_id": os.environ["CLIENT_ID"]
+    }
+        auth_url_params = f"{SPOTIFY_AUTH_URL}?{urlencode(auth_query_parameters)}"
+        return redirect(auth_url_params)
+
+
+    @app.route("/callback/q")
+    def callback():
+        return request_token()
+
+
+    @app.route('/shutdown', methods=['GET'])
+    def shutdown():
+        shutdown_server()
+        return 'Server shutting down...'
+
+    return app
 
 
 def shutdown_server():
     """Shuts the server down when GET method is invoked."""
+    from flask import request
+
     func = request.environ.get('werkzeug.server.shutdown')
     if func is None:
         raise RuntimeError('Not running with the Werkzeug Server')
@@ -0,0 +1,70 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Connection pool settings shared by Spotify API and token requests.
+POOL_SIZE = 10
+# (connect, read) timeouts in seconds.
+TIMEOUT = (3.05, 30)
+# Retries on connection errors and transient server errors.
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = (500, 502, 503, 504)
+
+_default_session = None
+_default_lock = threading.Lock()
+
+
+class ServerErrorRetry(Retry):
+    """Retry which leaves 429 responses to the caller, so that throttling is seen
+    and handled by ratelimit.RequestScheduler."""
+    RETRY_AFTER_STATUS_CODES = frozenset([413, 503])
+
+
+class PooledSession(requests.Session):
+    """requests.Session which applies default timeout to every request."""
+
+    def __init__(self, timeout=TIMEOUT) -> None:
+        super().__init__()
+        self.timeout = timeout
+
+
+    def request(self, method, url, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def create_session(
+    pool_size: int = POOL_SIZE,
+    timeout: tuple = TIMEOUT,
+    max_retries: int = MAX_RETRIES,
+    backoff_factor: float = BACKOFF_FACTOR
+) -> PooledSession:
+    """Creates a keep-alive session with connection pool and retry adapter mounted for HTTP(S)."""
+    retry = ServerErrorRetry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUSES,
+        respect_retry_after_header=True,
+        raise_on_status=False
+        )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = PooledSession(timeout=timeout)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+
+def get_default_session() -> PooledSession:
+    """Returns the process-wide session, creating it on first use."""
+    global _default_session
+    with _default_lock:
+        if _default_session is None:
+            _default_session = create_session()
+
+    return _default_session
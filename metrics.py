@@ -0,0 +1,226 @@
+import io
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+# Upper bounds of histogram buckets in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+# Number of functions and allocation sites printed by profile().
+PROFILE_TOP = 20
+
+
+class Histogram:
+    """Counts of observed values per bucket, with their sum, count and maximum."""
+
+    def __init__(self, buckets: tuple = BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+        self.max = 0
+
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+
+    def quantile(self, q: float) -> float:
+        """Estimates the q-quantile by linear interpolation within its bucket, the same
+        as Prometheus histogram_quantile()."""
+        rank = q * self.count
+        seen = 0
+        lower = 0
+        for bound, count in zip(self.buckets, self.counts):
+            if count and seen + count >= rank:
+                if bound == float("inf"):
+                    return self.max
+                return min(lower + (bound - lower) * (rank - seen) / count, self.max)
+            seen += count
+            lower = bound
+
+        return self.max
+
+
+class Metrics:
+    """Thread-safe registry of counters and histograms keyed by name and labels.
+
+    Exported as Prometheus text by to_prometheus() or as JSON report by report().
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started_at = time.time()
+
+
+    @staticmethod
+    def key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """Adds value to the counter."""
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Records value (in seconds) in the histogram."""
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Records the duration of the block in the histogram, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+
+    @staticmethod
+    def format_labels(labels: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in labels]
+        if extra:
+            pairs.append(extra)
+
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+    def to_prometheus(self) -> str:
+        """Returns all metrics in Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (metric, labels), value in sorted(self.counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{self.format_labels(labels)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else f"{bound}"
+                        bucket_labels = self.format_labels(labels, f'le="{le}"')
+                        lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                    lines.append(f"{name}_sum{self.format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{self.format_labels(labels)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+
+    def report(self) -> dict:
+        """Returns counters and histogram summaries (count, sum, p50, p95, p99, max)."""
+        def label_str(labels: tuple) -> str:
+            return ",".join(f"{name}={value}" for name, value in labels)
+
+        with self.lock:
+            return {
+                "started_at": self.started_at,
+                "elapsed": time.time() - self.started_at,
+                "counters": {
+                    name: {label_str(labels): value for (metric, labels), value in self.counters.items()
+                           if metric == name}
+                    for name in sorted({name for name, _ in self.counters})
+                    },
+                "histograms": {
+                    name: {
+                        label_str(labels): {
+                            "count": histogram.count,
+                            "sum": histogram.sum,
+                            "p50": histogram.quantile(0.5),
+                            "p95": histogram.quantile(0.95),
+                            "p99": histogram.quantile(0.99),
+                            "max": histogram.max
+                            }
+                        for (metric, labels), histogram in self.histograms.items() if metric == name
+                        }
+                    for name in sorted({name for name, _ in self.histograms})
+                    }
+                }
+
+
+    def write_report(self, path: str) -> None:
+        with open(path, mode="w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2)
+
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.started_at = time.time()
+
+
+# Process-wide registry used by app.py, database.py and pipeline.py.
+registry = Metrics()
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    registry.inc(name, value, **labels)
+
+
+def observe(name: str, value: float, **labels) -> None:
+    registry.observe(name, value, **labels)
+
+
+@contextmanager
+def stage(name: str):
+    """Times a pipeline stage in the stage_seconds histogram."""
+    with registry.timer("stage_seconds", stage=name):
+        yield
+
+
+def rows(stage_name: str, count: int) -> None:
+    """Counts rows which left the pipeline stage."""
+    registry.inc("stage_rows_total", count, stage=stage_name)
+
+
+@contextmanager
+def profile(path: str = None):
+    """Profiles the block with cProfile and tracemalloc, printing the slowest functions,
+    the largest allocation sites and peak traced memory. If path is given, cProfile
+    stats are dumped there for snakeviz or pstats. Adds overhead, so use it for single runs."""
+    import pstats
+    import cProfile
+    import tracemalloc
+
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(PROFILE_TOP)
+        print(output.getvalue())
+        print(f"Peak traced memory: {peak / 2 ** 20:.1f} MiB. Largest allocation sites:")
+        for stat in snapshot.statistics("lineno")[:PROFILE_TOP]:
+            print(f"  {stat}")
+        if path is not None:
+            profiler.dump_stats(path)
+            print(f"Profile written to {path}.")
@@ -0,0 +1,309 @@
+import sys
+import time
+
+from psycopg2 import sql
+
+import database
+
+
+# If you run "python migrations.py", the program will apply the pending schema
+# migrations, the same as "python database.py setup". Run "python migrations.py status"
+# to list the applied ones.
+#
+# Each migration is applied once and recorded in the schema_migrations table, so that
+# re-running the setup on an up-to-date database only reads that table. Migrations
+# check what already exists, so that databases set up by earlier versions of
+# "python database.py setup" converge to the same schema.
+
+# Key of the advisory lock which keeps two setups from migrating at the same time.
+LOCK_KEY = 4242001
+
+TABLES = {
+    "recent_tracks": {
+        # Identity columns are not supported on partitioned tables before PostgreSQL 17.
+        "id": "bigserial",
+        "user_id": f"TEXT NOT NULL DEFAULT '{database.DEFAULT_USER}'",
+        "played_at": "timestamp NOT NULL",
+        "track_id" :"TEXT",
+        "album_id" : "TEXT",
+        "artist_id": "TEXT"
+        },
+    "albums": {
+        "id": "integer GENERATED ALWAYS AS IDENTITY",
+        "album_id": "TEXT",
+        "album_name": "TEXT",
+        "album_release_date": "timestamp"
+        },
+    "artists": {
+        "id": "integer GENERATED ALWAYS AS IDENTITY",
+        "artist_id": "TEXT",
+        "artist_name": "TEXT",
+        "artist_popularity": "integer",
+        "followers": "integer"
+        },
+    "genres": {
+        "id": "integer GENERATED ALWAYS AS IDENTITY",
+        "genre_name": "TEXT"
+        },
+    "artists_genres": {
+        "id": "integer GENERATED ALWAYS AS IDENTITY",
+        "artist_id": "TEXT",
+        "genre_name": "TEXT"
+        },
+    "track_info": {
+        "id": "integer GENERATED ALWAYS AS IDENTITY",
+        "track_id": "TEXT",
+        "track_name": "TEXT",
+        "track_popularity": "integer",
+        "danceability": "decimal",
+        "energy": "decimal",
+        "key": "decimal",
+        "loudness": "decimal",
+        "mode": "decimal",
+        "speechiness": "decimal",
+        "acousticness": "decimal",
+        "instrumentalness": "decimal",
+        "liveness": "decimal",
+        "valence": "decimal",
+        "tempo": "decimal",
+        "duration_ms": "integer",
+        "time_signature": "integer",
+        "is_explicit": "bool"
+        }
+    }
+
+
+def constraint_exists(cursor, table_name: str, constraint_name: str) -> bool:
+    cursor.execute("SELECT 1 FROM pg_constraint WHERE conrelid = to_regclass(%s) AND conname = %s",
+                   (table_name, constraint_name))
+
+    return cursor.fetchone() is not None
+
+
+def is_partitioned(cursor, table_name: str) -> bool:
+    cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", (table_name,))
+
+    return cursor.fetchone() is not None
+
+
+def create_index(cursor, table_name: str, index_name: str, columns: str, unique: bool = False) -> None:
+    """Creates index if it's missing. Index on regular table is built CONCURRENTLY,
+    without blocking writes; index left invalid by an interrupted build is rebuilt.
+    Partitioned tables don't support CONCURRENTLY, their index is built directly."""
+    cursor.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (index_name,))
+    row = cursor.fetchone()
+    if row is not None and row[0]:
+        return
+    if row is not None:
+        cursor.execute(sql.SQL("DROP INDEX CONCURRENTLY {}").format(sql.Identifier(index_name)))
+
+    concurrently = sql.SQL("" if is_partitioned(cursor, table_name) else "CONCURRENTLY")
+    cursor.execute(sql.SQL("CREATE {unique} INDEX {concurrently} {index} ON {table} ({columns})").format(
+        unique=sql.SQL("UNIQUE" if unique else ""),
+        concurrently=concurrently,
+        index=sql.Identifier(index_name),
+        table=sql.Identifier(table_name),
+        columns=sql.SQL(", ").join(map(sql.Identifier, columns.split(", ")))
+        ))
+
+
+def add_key(cursor, table_name: str, constraint_name: str, columns: str, key_type: str = "PRIMARY KEY") -> None:
+    """Adds PRIMARY KEY or UNIQUE constraint if it's missing. On regular table, its index
+    is built CONCURRENTLY first and attached, so that the table is locked only briefly."""
+    if constraint_exists(cursor, table_name, constraint_name):
+        return
+
+    table = sql.Identifier(table_name)
+    constraint = sql.Identifier(constraint_name)
+    if is_partitioned(cursor, table_name):
+        cursor.execute(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {} ({})").format(
+            table, constraint, sql.SQL(key_type), sql.SQL(", ").join(map(sql.Identifier, columns.split(", ")))
+            ))
+        return
+
+    create_index(cursor, table_name, constraint_name, columns, unique=True)
+    cursor.execute(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {} USING INDEX {}").format(
+        table, constraint, sql.SQL(key_type), constraint
+        ))
+
+
+def add_fk(
+    cursor,
+    table_name: str,
+    constraint_name: str,
+    column: str,
+    table_name_fk: str,
+    column_fk: str
+) -> None:
+    """Adds FOREIGN KEY if it's missing. On regular table it's added NOT VALID and validated
+    afterwards, so that existing rows are checked without blocking writes. Partitioned
+    tables don't support NOT VALID foreign keys, their rows are checked directly."""
+    if not constraint_exists(cursor, table_name, constraint_name):
+        not_valid = sql.SQL("" if is_partitioned(cursor, table_name) else "NOT VALID")
+        cursor.execute(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} FOREIGN KEY ({}) REFERENCES {} ({}) {}").format(
+            sql.Identifier(table_name), sql.Identifier(constraint_name), sql.Identifier(column),
+            sql.Identifier(table_name_fk), sql.Identifier(column_fk), not_valid
+            ))
+
+    cursor.execute("SELECT convalidated FROM pg_constraint WHERE conrelid = to_regclass(%s) AND conname = %s",
+                   (table_name, constraint_name))
+    if not cursor.fetchone()[0]:
+        cursor.execute(sql.SQL("ALTER TABLE {} VALIDATE CONSTRAINT {}").format(
+            sql.Identifier(table_name), sql.Identifier(constraint_name)
+            ))
+
+
+def create_tables(db: database.Database, cursor) -> None:
+    # Executed on the migration's cursor, so that a failure stops the migration 
+    # before it is recorded as applied.
+    for table_name, cols in TABLES.items():
+        partition_by = "RANGE (played_at)" if table_name == "recent_tracks" else None
+        cursor.execute(db.create_table_query(cols, table_name, partition_by=partition_by))
+        print(f"Table {table_name} created succesfully.")
+
+
+def add_user_id(db: database.Database, cursor) -> None:
+    cursor.execute(sql.SQL("ALTER TABLE recent_tracks ADD COLUMN IF NOT EXISTS user_id {}").format(
+        sql.SQL(TABLES["recent_tracks"]["user_id"])
+        ))
+
+
+def partition_recent_tracks(db: database.Database, cursor) -> None:
+    db.migrate_recent_tracks()
+
+
+def add_primary_keys(db: database.Database, cursor) -> None:
+    add_key(cursor, "albums", "album_id_pk", "album_id")
+    add_key(cursor, "artists", "artist_id_pk", "artist_id")
+    add_key(cursor, "genres", "genre_name_pk", "genre_name")
+    add_key(cursor, "track_info", "track_id_pk", "track_id")
+    add_key(cursor, "recent_tracks", "played_at_pk", "user_id, played_at")
+
+
+def add_foreign_keys(db: database.Database, cursor) -> None:
+    add_fk(cursor, "recent_tracks", "track_id_fk", "track_id", "track_info", "track_id")
+    add_fk(cursor, "recent_tracks", "album_id_fk", "album_id", "albums", "album_id")
+    add_fk(cursor, "recent_tracks", "artist_id_fk", "artist_id", "artists", "artist_id")
+    add_fk(cursor, "artists_genres", "artist_id_fk", "artist_id", "artists", "artist_id")
+    add_fk(cursor, "artists_genres", "genre_name_fk", "genre_name", "genres", "genre_name")
+
+
+def add_unique_artist_genre(db: database.Database, cursor) -> None:
+    add_key(cursor, "artists_genres", "unique_artist_genre", "artist_id, genre_name", key_type="UNIQUE")
+
+
+def add_indexes(db: database.Database, cursor) -> None:
+    create_index(cursor, "recent_tracks", "recent_tracks_track_id_idx", "track_id")
+    create_index(cursor, "recent_tracks", "recent_tracks_album_id_idx", "album_id")
+    create_index(cursor, "recent_tracks", "recent_tracks_artist_id_idx", "artist_id")
+    create_index(cursor, "recent_tracks", "recent_tracks_played_at_idx", "played_at")
+    create_index(cursor, "artists_genres", "artists_genres_genre_name_idx", "genre_name")
+
+
+def create_stats_tables(db: database.Database, cursor) -> None:
+    """Creates rollups of listening statistics and aggregates the plays loaded so far."""
+    feature_cols = ", ".join(f"{feature}_sum numeric NOT NULL DEFAULT 0" for feature in db.STATS_FEATURES)
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            user_id TEXT,
+            day date,
+            plays bigint NOT NULL,
+            listened_ms bigint NOT NULL,
+            -- Plays of tracks with audio features, the divisor of the averages.
+            feature_plays bigint NOT NULL,
+            {feature_cols},
+            PRIMARY KEY (user_id, day));
+        CREATE TABLE IF NOT EXISTS stats_artists (
+            user_id TEXT,
+            artist_id TEXT,
+            plays bigint NOT NULL,
+            listened_ms bigint NOT NULL,
+            last_played_at timestamp,
+            PRIMARY KEY (user_id, artist_id));
+        CREATE TABLE IF NOT EXISTS stats_genres (
+            user_id TEXT,
+            genre_name TEXT,
+            plays bigint NOT NULL,
+            listened_ms bigint NOT NULL,
+            PRIMARY KEY (user_id, genre_name));
+        CREATE TABLE IF NOT EXISTS stats_tracks (
+            user_id TEXT,
+            track_id TEXT,
+            plays bigint NOT NULL,
+            listened_ms bigint NOT NULL,
+            last_played_at timestamp,
+            PRIMARY KEY (user_id, track_id));
+        """)
+    for table_name in ["stats_artists", "stats_genres", "stats_tracks"]:
+        create_index(cursor, table_name, f"{table_name}_plays_idx", "user_id, plays")
+    db.stats_enabled = True
+    print(f"Aggregated {db.refresh_stats()} plays.")
+
+
+# Migrations in the order they are applied: (version, name, function).
+# Append new migrations at the end and never change the applied ones.
+MIGRATIONS = [
+    (1, "create tables", create_tables),
+    (2, "add recent_tracks.user_id", add_user_id),
+    (3, "partition recent_tracks by month", partition_recent_tracks),
+    (4, "add primary keys", add_primary_keys),
+    (5, "add foreign keys", add_foreign_keys),
+    (6, "add unique artist genre constraint", add_unique_artist_genre),
+    (7, "add foreign key and date indexes", add_indexes),
+    (8, "create listening statistics rollups", create_stats_tables)
+    ]
+
+
+def applied_migrations(cursor) -> dict:
+    """Returns applied migrations as {version: applied_at}."""
+    cursor.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+                          version integer PRIMARY KEY,
+                          name TEXT NOT NULL,
+                          applied_at timestamptz NOT NULL DEFAULT now())""")
+    cursor.execute("SELECT version, applied_at FROM schema_migrations")
+
+    return dict(cursor.fetchall())
+
+
+def run_migrations(db: database.Database) -> list:
+    """Applies pending migrations in order, each one recorded as soon as it succeeds.
+    Returns versions of the applied migrations. Migrations run in autocommit mode,
+    as CONCURRENTLY can't run in a transaction. Use single-connection Database:
+    migrations borrow connections while the advisory lock is held."""
+    applied = []
+    with db.get_cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_lock(%s)", (LOCK_KEY,))
+        try:
+            done = applied_migrations(cursor)
+            for version, name, migrate in MIGRATIONS:
+                if version in done:
+                    continue
+                print(f"Applying migration {version}: {name}...")
+                start = time.perf_counter()
+                migrate(db, cursor)
+                cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+                print(f"Migration {version} applied in {time.perf_counter() - start:.2f} s.")
+                applied.append(version)
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (LOCK_KEY,))
+
+    if not applied:
+        print("Database schema is up to date.")
+
+    return applied
+
+
+def print_status(db: database.Database) -> None:
+    with db.get_cursor() as cursor:
+        done = applied_migrations(cursor)
+    for version, name, _ in MIGRATIONS:
+        status = f"applied {done[version]:%Y-%m-%d %H:%M:%S}" if version in done else "pending"
+        print(f"{version:>3} {name:<40} {status}")
+
+
+if __name__ == "__main__":
+    db = database.Database()
+    if len(sys.argv) > 1 and sys.argv[1] == "status":
+        print_status(db)
+    else:
+        run_migrations(db)
@@ -0,0 +1,133 @@
+import queue
+import threading
+
+import database
+import metrics
+from app import SpotifyAPI
+
+
+# Number of transformed chunks waiting for the loader. When the database falls behind,
+# the transform stage blocks on the full queue instead of piling chunks up in memory.
+QUEUE_SIZE = 2
+# Number of plays transformed and loaded at once.
+CHUNK_SIZE = 500
+
+
+def rechunk(pages, chunk_size: int = CHUNK_SIZE):
+    """Regroups the items of an iterable of lists into lists of chunk_size items."""
+    chunk = []
+    for page in pages:
+        chunk.extend(page)
+        while len(chunk) >= chunk_size:
+            yield chunk[:chunk_size]
+            chunk = chunk[chunk_size:]
+    if chunk:
+        yield chunk
+
+
+class Pipeline:
+    """Moves chunks of recently played items through extract -> enrich -> clean ->
+    validate -> load stages.
+
+    Chunks are extracted lazily from the given iterable and transformed in the calling
+    thread, while a loader thread loads the previous chunks, each in single transaction.
+    The bounded queue between them applies backpressure, so at most QUEUE_SIZE + 2
+    chunks are held in memory regardless of the size of the run. Chunks are loaded in
+    order; loading stops at the first failed chunk and the error is raised by run().
+    Both threads query the database, so it must be pooled with at least two connections.
+    """
+
+    def __init__(
+        self,
+        client: SpotifyAPI,
+        db: database.Database,
+        user_id: str = None,
+        queue_size: int = QUEUE_SIZE
+    ) -> None:
+        if db.pool is None:
+            raise Exception("Pipeline needs pooled database, e.g. database.Database(max_connections=2).")
+        self.client = client
+        self.db = db
+        self.user_id = user_id
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.report = {}
+
+
+    def transform(self, items: list) -> dict:
+        """Turns items into DataFrames keyed by table name, or None if there is nothing to load."""
+        if not items:
+            return None
+        with metrics.stage("extract"):
+            recently_played = self.client.flatten_recently_played(items)
+            # played_at is the primary key; a chunk may contain several plays per timestamp.
+            recently_played = recently_played.drop_duplicates(subset=["played_at"])
+        metrics.rows("extract", len(recently_played))
+        df = self.client.enrich_tracks_data(recently_played, self.db)
+        if df.empty:
+            return None
+        df = self.client.transform_tracks_data(df)
+        if df.empty:
+            return None
+
+        return self.client.split_into_tables(df, self.user_id)
+
+
+    def load_worker(self, on_loaded) -> None:
+        """Loads queued chunks until the end of the run. After an error the remaining
+        chunks are discarded, so that the transform stage is never blocked."""
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            index, tables = task
+            if self.error is not None:
+                continue
+            try:
+                if tables is not None:
+                    for table_name, counts in self.db.load_batch(tables).items():
+                        totals = self.report.setdefault(table_name, {"inserted": 0, "skipped": 0})
+                        totals["inserted"] += counts["inserted"]
+                        totals["skipped"] += counts["skipped"]
+                if on_loaded is not None:
+                    on_loaded(index)
+            except Exception as error:
+                self.error = error
+
+
+    def run(self, chunks, on_loaded=None) -> dict:
+        """Transforms and loads chunks of items. on_loaded(index) is called by the loader
+        thread after the chunk with that index is loaded (or found to be empty).
+        Returns numbers of inserted and skipped rows per table."""
+        loader = threading.Thread(target=self.load_worker, args=(on_loaded,), daemon=True)
+        loader.start()
+        try:
+            for index, items in enumerate(chunks):
+                if self.error is not None:
+                    break
+                tables = self.transform(items)
+                # Time blocked on the full queue, i.e. waiting for the loader.
+                with metrics.registry.timer("pipeline_queue_wait_seconds"):
+                    self.queue.put((index, tables))
+                metrics.inc("pipeline_chunks_total")
+        finally:
+            self.queue.put(None)
+            loader.join()
+        if self.error is not None:
+            raise self.error
+
+        return self.report
+
+
+def load_recently_played(client: SpotifyAPI, db: database.Database, user_id: str = database.DEFAULT_USER,
+                         chunk_size: int = CHUNK_SIZE) -> int:
+    """Loads the user's tracks played since the last loaded one through the pipeline.
+    Returns the number of new plays."""
+    pages = client.iter_recently_played_pages(after=db.get_last_played_at(user_id))
+    report = Pipeline(client, db, user_id).run(rechunk(pages, chunk_size))
+    if not report:
+        print("No new tracks played.")
+    for table_name, counts in report.items():
+        print(f"Table {table_name}: {counts['inserted']} rows inserted, {counts['skipped']} skipped.")
+
+    return report.get("recent_tracks", {}).get("inserted", 0)
@@ -0,0 +1,300 @@
+import math
+import time
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+
+import metrics
+
+
+# Initial, minimum and maximum request rates (requests/s) of AdaptiveRateLimiter.
+RATE = 10
+MIN_RATE = 0.5
+MAX_RATE = 50
+# Rate increase in requests/s per second without throttling, and rate multiplier on 429.
+INCREASE = 1
+DECREASE = 0.5
+# Requests sent at once by RequestScheduler's workers.
+WORKERS = 4
+# Retry policy for throttled (429) requests. Connection errors and 5xx
+# responses are retried by the session's retry adapter.
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 1
+
+_default_scheduler = None
+_default_lock = threading.Lock()
+
+
+def parse_retry_after(value: str) -> float:
+    """Returns the seconds to wait given by a Retry-After header, either in seconds or
+    as an HTTP-date. Returns None if the header is missing or malformed."""
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return None
+    if not math.isfinite(seconds):
+        return None
+
+    return max(seconds, 0)
+
+
+class RateLimiter:
+    """Thread-safe token bucket limiting the rate of requests.
+
+    `rate` tokens are added per second, up to `burst` tokens.
+    """
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def reserve(self) -> float:
+        """Takes one token and returns the number of seconds to wait before using it."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            # Token is borrowed from the future; wait until it is refilled.
+            return -self.tokens / self.rate
+
+
+    def acquire(self) -> None:
+        """Blocks until the request is allowed."""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+    def on_success(self) -> None:
+        """Called after a request which was not throttled. Fixed rate ignores it."""
+
+
+    def on_throttled(self, retry_after: float) -> None:
+        """Called after a throttled (429) request. Fixed rate ignores it."""
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """Token bucket whose rate adapts to throttling with additive increase and
+    multiplicative decrease (AIMD).
+
+    Every request which is not throttled raises the rate by `increase` / rate, i.e. by
+    about `increase` requests/s per second at full rate, up to `max_rate`. A 429 response
+    multiplies the rate by `decrease`, down to `min_rate`, and pauses all requests for 
+    Retry-After seconds. Throttled responses of requests sent before the pause count 
+    as the same episode, so the rate is decreased once per episode.
+    """
+
+    def __init__(
+        self,
+        rate: float = RATE,
+        burst: int = 1,
+        min_rate: float = MIN_RATE,
+        max_rate: float = MAX_RATE,
+        increase: float = INCREASE,
+        decrease: float = DECREASE
+    ) -> None:
+        super().__init__(rate, burst)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.throttled_until = 0
+
+
+    def on_success(self) -> None:
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+
+    def on_throttled(self, retry_after: float) -> None:
+        with self.lock:
+            now = time.monotonic()
+            if now < self.throttled_until:
+                return
+            self.throttled_until = now + retry_after
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            # Debt of retry_after seconds' worth of tokens pauses every reservation.
+            self.tokens = min(self.tokens, 0) - retry_after * self.rate
+
+
+class Request:
+    """Request waiting in RequestScheduler's queue."""
+
+    def __init__(self, send) -> None:
+        self.send = send
+        self.attempt = 0
+        self.future = Future()
+
+
+class RequestScheduler:
+    """Sends the requests of all clients sharing one API budget with a pool of worker threads.
+
+    Requests wait in a priority queue and are sent no faster than the rate limiter allows.
+    Throttled (429) requests are put back into the queue and retried after Retry-After,
+    or after exponential backoff without it, up to max_retries times, ahead of new
+    requests. Workers keep sending other requests meanwhile; only the caller of the
+    throttled request waits. Pass AdaptiveRateLimiter to adapt the rate to throttling.
+    """
+    # Priorities of the queued requests, lower first.
+    RETRY = 0
+    NEW = 1
+
+    def __init__(
+        self,
+        rate_limiter: RateLimiter = None,
+        workers: int = WORKERS,
+        max_retries: int = MAX_RETRIES,
+        backoff_seconds: float = BACKOFF_SECONDS
+    ) -> None:
+        self.rate_limiter = rate_limiter or AdaptiveRateLimiter()
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        # (priority, sequence number, request) of requests ready to be sent.
+        self.ready = []
+        # (time, sequence number, request) of throttled requests waiting for retry.
+        self.delayed = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.threads = []
+        self.stopped = False
+        self.retries = 0
+
+
+    def submit(self, send) -> Future:
+        """Queues send(), which performs the request and returns the requests.Response.
+        Returns future of the last response."""
+        request = Request(send)
+        with self.condition:
+            if self.stopped:
+                raise Exception("Request scheduler is closed.")
+            if not self.threads:
+                self.start()
+            heapq.heappush(self.ready, (self.NEW, next(self.sequence), request))
+            self.condition.notify()
+
+        return request.future
+
+
+    def request(self, send) -> requests.Response:
+        """Queues send() and waits for its last response."""
+        return self.submit(send).result()
+
+
+    def start(self) -> None:
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+
+    def next_request(self) -> Request:
+        """Waits for the next request to send. Returns None when the scheduler is closed."""
+        with self.condition:
+            while not self.stopped:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    _, sequence, request = heapq.heappop(self.delayed)
+                    heapq.heappush(self.ready, (self.RETRY, sequence, request))
+                if self.ready:
+                    return heapq.heappop(self.ready)[2]
+                self.condition.wait(self.delayed[0][0] - now if self.delayed else None)
+
+        return None
+
+
+    def work(self) -> None:
+        while True:
+            request = self.next_request()
+            if request is None:
+                return
+            # Any failure goes to the caller of the request, so that it doesn't wait
+            # forever, and the worker keeps sending the other requests.
+            try:
+                self.send(request)
+            except Exception as error:
+                if not request.future.done():
+                    request.future.set_exception(error)
+
+
+    def send(self, request: Request) -> None:
+        """Sends the request. Resolves its future, or queues it for retry when throttled."""
+        self.rate_limiter.acquire()
+        r = request.send()
+        if r.status_code != 429:
+            self.rate_limiter.on_success()
+            request.future.set_result(r)
+            return
+
+        delay = parse_retry_after(r.headers.get("Retry-After"))
+        if delay is None:
+            delay = self.backoff_seconds * 2 ** request.attempt
+        self.rate_limiter.on_throttled(delay)
+        if request.attempt == self.max_retries:
+            request.future.set_result(r)
+            return
+        print(f"Request failed with status code {r.status_code}. Retrying in {delay} s...")
+        request.attempt += 1
+        metrics.inc("http_retries_total")
+        with self.condition:
+            if self.stopped:
+                raise Exception("Request scheduler is closed.")
+            self.retries += 1
+            heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.sequence), request))
+            self.condition.notify()
+
+
+    def stats(self) -> dict:
+        """Returns the current rate, the numbers of queued requests and of retries so far."""
+        with self.condition:
+            return {
+                "rate": self.rate_limiter.rate,
+                "ready": len(self.ready),
+                "delayed": len(self.delayed),
+                "retries": self.retries
+                }
+
+
+    def close(self) -> None:
+        """Stops the workers after their current requests. Queued requests fail with an
+        exception, so that their callers don't wait forever; new requests are rejected."""
+        with self.condition:
+            self.stopped = True
+            pending = [request for _, _, request in self.ready + self.delayed]
+            self.ready = []
+            self.delayed = []
+            self.condition.notify_all()
+        for request in pending:
+            request.future.set_exception(Exception("Request scheduler is closed."))
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+def get_default_scheduler() -> RequestScheduler:
+    """Returns the process-wide scheduler, creating it on first use."""
+    global _default_scheduler
+    with _default_lock:
+        if _default_scheduler is None:
+            _default_scheduler = RequestScheduler()
+
+    return _default_scheduler
@@ -0,0 +1,216 @@
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import get_auth_code
+import database
+import cache
+from app import SpotifyAPI
+from ratelimit import AdaptiveRateLimiter, RequestScheduler
+
+
+# If you run "python scheduler.py", the program will poll recently played tracks
+# of every account in ACCOUNTS_DIR and load them into the database, until stopped.
+# Run "python scheduler.py add <user_id>" to authorize an account and add it.
+
+# One token file per account, named <user_id>.json, in the secrets.json format.
+ACCOUNTS_DIR = "accounts"
+# Seconds between polls of the same account.
+POLL_INTERVAL = 300
+WORKERS = 8
+# Initial Spotify API request rate per second, shared by all workers. It adapts 
+# to throttling: it rises while requests succeed and halves on 429 responses.
+RATE_LIMIT = 20
+# Seconds between printed scheduler stats.
+REPORT_INTERVAL = 60
+
+
+class Account:
+    """Spotify account polled by the scheduler, with its token and high-water mark."""
+
+    def __init__(self, user_id: str, token_file: str) -> None:
+        self.user_id = user_id
+        # Refreshed on demand by the polling worker, to avoid a timer thread per account.
+        self.tokens = get_auth_code.TokenManager(token_file, background=False)
+        # Time of the latest loaded play, read from the database on the first poll.
+        self.last_played_at = None
+        self.next_poll_at = 0
+        self.polls = 0
+        self.errors = 0
+        self.last_error = None
+        self.last_latency = None
+        self.last_rows = 0
+
+
+    def get_token(self) -> str:
+        """Returns access token, refreshed ahead of its expiration."""
+        return self.tokens.get_token()
+
+
+def get_accounts_dir(accounts_dir: str = ACCOUNTS_DIR) -> str:
+    """Resolves accounts directory relative to this file, the same as secrets.json."""
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), accounts_dir)
+
+
+def load_accounts(accounts_dir: str = ACCOUNTS_DIR) -> list:
+    """Returns accounts of all token files in the directory."""
+    accounts_dir = get_accounts_dir(accounts_dir)
+    token_files = sorted(glob.glob(os.path.join(accounts_dir, "*.json")))
+    return [Account(os.path.splitext(os.path.basename(path))[0], path) for path in token_files]
+
+
+class Scheduler:
+    """Polls many accounts with a pool of worker threads.
+
+    Polls are spread evenly over the poll interval. Requests of all workers go
+    through one request scheduler, so that the API budget is shared. Workers borrow
+    connections from one pool of at most `workers` database connections.
+    """
+
+    def __init__(
+        self,
+        accounts: list,
+        workers: int = WORKERS,
+        rate_limit: float = RATE_LIMIT,
+        poll_interval: float = POLL_INTERVAL,
+        metadata_cache: cache.MetadataCache = None,
+        db: database.Database = None
+    ) -> None:
+        self.accounts = accounts
+        self.poll_interval = poll_interval
+        self.requests = RequestScheduler(AdaptiveRateLimiter(rate_limit, burst=workers), workers=workers)
+        self.cache = metadata_cache
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.db = db or database.Database(max_connections=workers)
+        self.lock = threading.Lock()
+        self.in_flight = set()
+
+        now = time.time()
+        for i, account in enumerate(accounts):
+            account.next_poll_at = now + i * poll_interval / max(len(accounts), 1)
+
+
+    def poll(self, account: Account) -> None:
+        """Extracts the account's plays since its high-water mark and loads them."""
+        start = time.monotonic()
+        try:
+            db = self.db
+            if account.last_played_at is None:
+                account.last_played_at = db.get_last_played_at(account.user_id)
+            client = SpotifyAPI(account.get_token(), cache=self.cache, scheduler=self.requests)
+            df = client.get_tracks_data(db, after=account.last_played_at)
+            account.last_rows = len(df)
+            if not df.empty:
+                db.load_batch(client.split_into_tables(df, account.user_id))
+                account.last_played_at = db.get_last_played_at(account.user_id)
+        except Exception as error:
+            account.errors += 1
+            account.last_error = str(error)
+            print(f"Polling account {account.user_id} failed: {error}")
+        finally:
+            account.polls += 1
+            account.last_latency = time.monotonic() - start
+            account.next_poll_at = time.time() + self.poll_interval
+            with self.lock:
+                self.in_flight.discard(account.user_id)
+
+
+    def submit_due(self) -> None:
+        """Submits polls of the accounts which are due and not already being polled."""
+        now = time.time()
+        for account in self.accounts:
+            with self.lock:
+                if account.user_id in self.in_flight or account.next_poll_at > now:
+                    continue
+                self.in_flight.add(account.user_id)
+            self.executor.submit(self.poll, account)
+
+
+    def stats(self) -> dict:
+        """Returns backlog and per-account cycle stats."""
+        now = time.time()
+        with self.lock:
+            in_flight = len(self.in_flight)
+        overdue = [account for account in self.accounts if account.next_poll_at <= now]
+
+        return {
+            "accounts": len(self.accounts),
+            "in_flight": in_flight,
+            "requests": self.requests.stats(),
+            # Polls which are due but wait for a free worker.
+            "backlog": max(len(overdue) - in_flight, 0),
+            "users": {
+                account.user_id: {
+                    "polls": account.polls,
+                    "errors": account.errors,
+                    "last_error": account.last_error,
+                    "last_latency": account.last_latency,
+                    "last_rows": account.last_rows,
+                    "next_poll_in": max(account.next_poll_at - now, 0)
+                    }
+                for account in self.accounts
+                }
+            }
+
+
+    def run(self, stop_event: threading.Event = None) -> None:
+        """Polls accounts until stop_event is set."""
+        stop_event = stop_event or threading.Event()
+        reported_at = time.time()
+        while not stop_event.is_set():
+            self.submit_due()
+            if time.time() - reported_at >= REPORT_INTERVAL:
+                stats = self.stats()
+                latencies = [user["last_latency"] for user in stats["users"].values() if user["last_latency"]]
+                mean_latency = sum(latencies) / len(latencies) if latencies else 0
+                print(f"Accounts: {stats['accounts']}, in flight: {stats['in_flight']}, "
+                      f"backlog: {stats['backlog']}, mean cycle latency: {mean_latency:.2f} s, "
+                      f"request rate: {stats['requests']['rate']:.1f}/s, retries: {stats['requests']['retries']}")
+                reported_at = time.time()
+            stop_event.wait(1)
+        self.executor.shutdown(wait=True)
+        self.requests.close()
+
+
+def add_account(user_id: str, accounts_dir: str = ACCOUNTS_DIR) -> None:
+    """Authorizes the account in the browser and stores its tokens in the accounts directory.
+    secrets.json of the single-user app is restored afterwards."""
+    accounts_dir = get_accounts_dir(accounts_dir)
+    secrets_file = os.path.join(os.path.dirname(os.path.abspath(get_auth_code.__file__)), 
+                                get_auth_code.JSON_handler.SECRETS_FILE)
+    backup_file = f"{secrets_file}.bak"
+    if os.path.exists(secrets_file):
+        os.replace(secrets_file, backup_file)
+    try:
+        with open(secrets_file, mode="w", encoding="utf-8") as f:
+            json.dump({}, f)
+        get_auth_code.obtain_auth_code()
+        get_auth_code.get_token()
+        os.makedirs(accounts_dir, exist_ok=True)
+        shutil.copy(secrets_file, os.path.join(accounts_dir, f"{user_id}.json"))
+    finally:
+        if os.path.exists(backup_file):
+            os.replace(backup_file, secrets_file)
+    print(f"Account {user_id} added.")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "add":
+        add_account(sys.argv[2])
+        sys.exit(0)
+
+    accounts = load_accounts()
+    if not accounts:
+        print(f"No accounts found in {get_accounts_dir()}. Add one with: python scheduler.py add <user_id>")
+        sys.exit(1)
+
+    scheduler = Scheduler(accounts, metadata_cache=cache.MetadataCache())
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        print("Stopping scheduler...")
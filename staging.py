@@ -0,0 +1,141 @@
+import os
+import uuid
+import argparse
+from datetime import date, datetime, timezone
+
+from pandas.core.frame import DataFrame
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import database
+from app import SpotifyAPI
+
+
+# If you run "python staging.py", the program will load the tracks data staged by
+# "python app.py --stage" into the database, without requesting anything from Spotify.
+
+STAGING_DIR = "staging"
+# Parquet compression codec of the staged files.
+COMPRESSION = "zstd"
+# Tracks data as merged from the API responses, and after clean_df().
+KINDS = ["raw", "clean"]
+# Columns which clean_df() and check_if_data_valid() need in raw tracks data.
+CLEAN_COLUMNS = ["played_at", "album_release_date"] + SpotifyAPI.CATEGORICAL_COLUMNS
+
+
+class StagingSink:
+    """Parquet files of tracks data partitioned by the date of play, laid out as
+    <directory>/<kind>/date=YYYY-MM-DD/<timestamp>-<id>.parquet.
+
+    Every write adds new files, so runs never rewrite each other's data. Files are
+    written under a hidden temporary name and renamed when complete, so readers
+    never see partial files.
+    """
+
+    def __init__(self, directory: str = STAGING_DIR, compression: str = COMPRESSION) -> None:
+        if not os.path.isabs(directory):
+            directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), directory)
+        self.directory = directory
+        self.compression = compression
+
+
+    def write(self, kind: str, df: DataFrame) -> list:
+        """Writes tracks data into one file per date of play. Returns the paths."""
+        if kind not in KINDS:
+            raise Exception(f"Unknown kind of tracks data: {kind}. Use one of: {', '.join(KINDS)}.")
+        name = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:8]}.parquet"
+        paths = []
+        # played_at is ISO 8601 in UTC, so its first 10 characters are the date of play.
+        for day, part in df.groupby(df["played_at"].str[:10], sort=True):
+            directory = os.path.join(self.directory, kind, f"date={day}")
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, name)
+            # Files starting with "." are skipped by readers.
+            temporary_path = os.path.join(directory, f".{name}")
+            pq.write_table(pa.Table.from_pandas(part, preserve_index=False), temporary_path,
+                           compression=self.compression)
+            os.replace(temporary_path, path)
+            paths.append(path)
+
+        return paths
+
+
+    def partitions(self, kind: str, start: date = None, end: date = None) -> list:
+        """Returns (date, directory) of the partitions between start and end (inclusive), by date."""
+        root = os.path.join(self.directory, kind)
+        if not os.path.isdir(root):
+            return []
+        partitions = []
+        for entry in sorted(os.listdir(root)):
+            if not entry.startswith("date="):
+                continue
+            day = date.fromisoformat(entry[len("date="):])
+            if (start is None or day >= start) and (end is None or day <= end):
+                partitions.append((day, os.path.join(root, entry)))
+
+        return partitions
+
+
+    @staticmethod
+    def read(directory: str, columns: list = None) -> DataFrame:
+        """Reads the files of the partition, memory-mapped and pruned to the columns."""
+        return pq.read_table(directory, columns=columns, memory_map=True).to_pandas()
+
+
+def replay(
+    db: database.Database,
+    sink: StagingSink = None,
+    kind: str = "clean",
+    start: date = None,
+    end: date = None,
+    tables: list = None,
+    user_id: str = None
+) -> dict:
+    """Loads staged tracks data into the tables (all by default), one date of play at
+    a time, each in single transaction. Only the columns needed by the tables are read.
+    Raw tracks data is cleaned and validated again before loading. If user_id is given,
+    plays are tagged with it. Returns numbers of inserted and skipped rows per table."""
+    sink = sink or StagingSink()
+    client = SpotifyAPI(None)
+    tables = tables or SpotifyAPI.TABLES
+    columns = SpotifyAPI.source_columns(tables)
+    if kind == "raw":
+        columns += [column for column in CLEAN_COLUMNS if column not in columns]
+
+    report = {}
+    for day, directory in sink.partitions(kind, start, end):
+        df = sink.read(directory, columns)
+        if "played_at" in df:
+            # Overlapping runs may have staged the same play twice.
+            df = df.drop_duplicates(subset=["played_at"])
+        if kind == "raw":
+            df = client.clean_df(df)
+            if not client.check_if_data_valid(df):
+                continue
+        for table_name, counts in db.load_batch(client.split_into_tables(df, user_id, tables)).items():
+            totals = report.setdefault(table_name, {"inserted": 0, "skipped": 0})
+            totals["inserted"] += counts["inserted"]
+            totals["skipped"] += counts["skipped"]
+        print(f"Replayed {len(df)} rows of {day}.")
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load staged tracks data into the database.")
+    parser.add_argument("--dir", default=STAGING_DIR, help="staging directory")
+    parser.add_argument("--kind", choices=KINDS, default="clean",
+                        help="replay clean tracks data, or raw tracks data cleaned again")
+    parser.add_argument("--start", type=date.fromisoformat, help="first date of play (YYYY-MM-DD)")
+    parser.add_argument("--end", type=date.fromisoformat, help="last date of play (YYYY-MM-DD)")
+    parser.add_argument("--tables", nargs="+", choices=SpotifyAPI.TABLES,
+                        help="load only these tables, reading only their columns")
+    args = parser.parse_args()
+
+    db = database.Database()
+    report = replay(db, StagingSink(args.dir), args.kind, args.start, args.end, args.tables)
+    if not report:
+        print("No staged tracks data found.")
+    for table_name, counts in report.items():
+        print(f"Table {table_name}: {counts['inserted']} rows inserted, {counts['skipped']} skipped.")
+    db.count_records()
@@ -0,0 +1,43 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import benchmark
+import http_session
+import metrics
+from async_api import AsyncSpotifyAPI
+from ratelimit import RateLimiter, RequestScheduler
+
+
+@pytest.fixture
+def stub():
+    with benchmark.StubServer(n_plays=50) as stub:
+        yield stub
+
+
+@pytest.fixture
+def client(stub):
+    scheduler = RequestScheduler(RateLimiter(rate=1000, burst=10))
+    executor = ThreadPoolExecutor(max_workers=1)
+    client = AsyncSpotifyAPI("token", session=http_session.create_session(), concurrency=1,
+                             scheduler=scheduler, executor=executor)
+    client.BASE_URL = stub.base_url
+    yield client
+    executor.shutdown()
+    scheduler.close()
+
+
+def test_tracks_data_extracted_twice_with_one_client(client):
+    # Each call runs its own event loop, which must not reuse the semaphore of the first.
+    assert len(client.get_tracks_data()) == 50
+    assert len(client.get_tracks_data()) == 50
+
+
+def test_stages_are_timed(client):
+    metrics.registry.reset()
+
+    client.get_tracks_data()
+
+    exposition = metrics.registry.to_prometheus()
+    for stage in ["extract", "enrich_db", "enrich_api", "merge", "clean", "validate"]:
+        assert f'stage_seconds_count{{stage="{stage}"}} 1' in exposition
@@ -0,0 +1,52 @@
+import pytest
+import pandas as pd
+
+import benchmark
+import http_session
+from app import SpotifyAPI
+from ratelimit import RateLimiter, RequestScheduler
+
+
+@pytest.fixture
+def stub():
+    with benchmark.StubServer() as stub:
+        yield stub
+
+
+@pytest.fixture
+def client(stub):
+    scheduler = RequestScheduler(RateLimiter(rate=1000, burst=10))
+    client = SpotifyAPI("token", session=http_session.create_session(), scheduler=scheduler)
+    client.BASE_URL = stub.base_url
+    yield client
+    scheduler.close()
+
+
+def test_artists_requested_in_batches_of_50(stub, client):
+    artist_ids = [f"artist{i:06d}" for i in range(120)]
+
+    artist_df = client.get_artist_data(pd.DataFrame({"artist_id": artist_ids}))
+
+    assert stub.request_count == 3
+    assert artist_df["artist_id"].tolist() == artist_ids
+
+
+def test_audio_features_requested_in_batches_of_100(stub, client):
+    track_ids = [f"track{i:06d}" for i in range(250)]
+
+    features_df = client.get_track_features(pd.DataFrame({"track_id": track_ids}))
+
+    assert stub.request_count == 3
+    assert features_df["track_id"].tolist() == track_ids
+
+
+def test_null_entries_of_batch_response_are_left_out(stub, client, monkeypatch):
+    unresolved = {"artist000007", "artist000042"}
+    fake_artist = benchmark.fake_artist
+    monkeypatch.setattr(benchmark, "fake_artist", lambda id: None if id in unresolved else fake_artist(id))
+    artist_ids = [f"artist{i:06d}" for i in range(60)]
+
+    artist_df = client.get_artist_data(pd.DataFrame({"artist_id": artist_ids}))
+
+    assert stub.request_count == 2
+    assert artist_df["artist_id"].tolist() == [id for id in artist_ids if id not in unresolved]
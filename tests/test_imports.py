@@ -0,0 +1,11 @@
+import pytest
+
+import benchmark
+
+
+@pytest.mark.parametrize("module", list(benchmark.LAZY_IMPORTS))
+def test_heavy_dependencies_are_imported_lazily(module):
+    _, imported = benchmark.import_time(module)
+
+    eager = [name for name in benchmark.LAZY_IMPORTS[module] if name in imported]
+    assert not eager, f"importing {module} loads {', '.join(eager)}"
@@ -0,0 +1,42 @@
+import requests
+
+from ratelimit import RateLimiter, RequestScheduler, parse_retry_after
+
+
+def response(status_code: int, headers: dict = None) -> requests.Response:
+    r = requests.Response()
+    r.status_code = status_code
+    r.headers.update(headers or {})
+    return r
+
+
+def test_retry_after_in_seconds_and_http_date():
+    assert parse_retry_after("2") == 2
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert parse_retry_after("soon") is None
+    assert parse_retry_after(None) is None
+
+
+def test_throttled_request_with_http_date_is_retried():
+    responses = [response(429, {"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}), response(200)]
+    scheduler = RequestScheduler(RateLimiter(rate=1000, burst=10), workers=1)
+    try:
+        assert scheduler.submit(lambda: responses.pop(0)).result(timeout=5).status_code == 200
+        assert scheduler.stats()["retries"] == 1
+    finally:
+        scheduler.close()
+
+
+def test_failure_after_send_resolves_future_and_keeps_worker():
+    class FailingLimiter(RateLimiter):
+        def on_success(self) -> None:
+            raise ValueError("limiter failed")
+
+    scheduler = RequestScheduler(FailingLimiter(rate=1000, burst=10), workers=1)
+    try:
+        future = scheduler.submit(lambda: response(200))
+        assert isinstance(future.exception(timeout=5), ValueError)
+        assert scheduler.threads[0].is_alive()
+        assert isinstance(scheduler.submit(lambda: response(200)).exception(timeout=5), ValueError)
+    finally:
+        scheduler.close()
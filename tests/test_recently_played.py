@@ -0,0 +1,48 @@
+from datetime import timedelta
+
+import pytest
+
+import benchmark
+import http_session
+from app import SpotifyAPI
+from ratelimit import RateLimiter, RequestScheduler
+
+
+@pytest.fixture
+def stub():
+    with benchmark.StubServer(n_plays=120) as stub:
+        yield stub
+
+
+@pytest.fixture
+def client(stub):
+    scheduler = RequestScheduler(RateLimiter(rate=1000, burst=10))
+    client = SpotifyAPI("token", session=http_session.create_session(), scheduler=scheduler)
+    client.BASE_URL = stub.base_url
+    yield client
+    scheduler.close()
+
+
+def test_only_plays_after_cursor_are_read(stub, client):
+    after = benchmark.PLAYS_START + timedelta(seconds=29)
+
+    df = client.get_recently_played(after)
+
+    # Pages of plays 119-70 and 69-20; paging stops at the plays up to `after`.
+    assert stub.request_count == 2
+    assert sorted(df["played_at"]) == [benchmark.fake_played_at(i) for i in range(30, 120)]
+
+
+def test_all_pages_read_when_all_plays_are_new(stub, client):
+    df = client.get_recently_played(benchmark.PLAYS_START - timedelta(days=1))
+
+    assert stub.request_count == 3
+    assert df["played_at"].is_unique
+    assert len(df) == 120
+
+
+def test_last_50_plays_read_without_cursor(stub, client):
+    df = client.get_recently_played()
+
+    assert stub.request_count == 1
+    assert sorted(df["played_at"]) == [benchmark.fake_played_at(i) for i in range(70, 120)]